@@ -0,0 +1,75 @@
+# bench_message_memory.py
+# Compares server memory per stored chat message for the old layout (a dict per
+# direction with an ISO timestamp string) and the ChatMessage records shared by
+# both sides of a conversation.
+#
+# Usage: python bench_message_memory.py [messages] [users]
+
+import os
+import sys
+import time
+import uuid
+import random
+import tempfile
+import tracemalloc
+from datetime import datetime
+
+MESSAGES = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+USERS = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+
+# server.py creates its data files relative to the working directory
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+os.chdir(tempfile.mkdtemp(prefix="connect_bench_"))
+sys.path.insert(0, SCRIPT_DIR)
+import server  # noqa: E402
+
+def make_traffic():
+    """(msg_id, sender, recipient, text) tuples; names are fresh strings, as when parsed off the wire."""
+    rng = random.Random(0)
+    traffic = []
+    for i in range(MESSAGES):
+        a, b = rng.sample(range(USERS), 2)
+        traffic.append((uuid.uuid4().hex, f"user{a}", f"user{b}", f"message number {i} " + "x" * rng.randint(0, 60)))
+    return traffic
+
+def build_legacy(traffic):
+    history = {}
+    for msg_id, sender, recipient, text in traffic:
+        for a, b in [(sender, recipient), (recipient, sender)]:
+            history.setdefault(a, {}).setdefault(b, []).append({
+                "id": msg_id,
+                "sender": "".join(sender),
+                "message": text,
+                "timestamp": datetime.now().isoformat(),
+                "ai": False
+            })
+    return history
+
+def build_compact(traffic):
+    server.chat_history = {}
+    for msg_id, sender, recipient, text in traffic:
+        server.conversation(sender, recipient).append(
+            server.ChatMessage(msg_id, "".join(sender), text, int(time.time())))
+    return server.chat_history
+
+def measure(build, traffic):
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    history = build(traffic)
+    used = tracemalloc.get_traced_memory()[0] - start
+    tracemalloc.stop()
+    return history, used
+
+if __name__ == "__main__":
+    traffic = make_traffic()
+    text_bytes = sum(sys.getsizeof(t[3]) + sys.getsizeof(t[0]) for t in traffic)
+
+    print(f"{MESSAGES} messages between {USERS} users "
+          f"(message text and IDs: {text_bytes / MESSAGES:.0f} bytes/message, shared by both layouts)")
+    results = []
+    for label, build in [("dict per direction", build_legacy), ("ChatMessage records", build_compact)]:
+        history, used = measure(build, traffic)
+        results.append(used)
+        print(f"{label:>20}: {used / MESSAGES:8.1f} bytes/message overhead, {used / (1024 * 1024):8.1f} MB total")
+        del history
+    print(f"{'saved':>20}: {(1 - results[1] / results[0]) * 100:.0f}%")
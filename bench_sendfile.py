@@ -0,0 +1,92 @@
+# bench_sendfile.py
+# Compares file-server download throughput and server CPU per GB served
+# for the zero-copy sendfile path vs the buffered copyfile path.
+#
+# Usage: python bench_sendfile.py [size_mb] [rounds]
+
+import os
+import sys
+import time
+import tempfile
+import threading
+import http.client
+import socketserver
+
+SIZE_MB = int(sys.argv[1]) if len(sys.argv) > 1 else 256
+ROUNDS = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+# server.py creates its data files relative to the working directory
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+os.chdir(tempfile.mkdtemp(prefix="connect_bench_"))
+sys.path.insert(0, SCRIPT_DIR)
+import server  # noqa: E402
+
+server_cpu = []
+
+class TimedHandler(server.FileUploadHandler):
+    def do_GET(self):
+        start = time.thread_time()
+        super().do_GET()
+        server_cpu.append(time.thread_time() - start)
+
+    def log_message(self, format, *args):
+        pass
+
+def make_payload():
+    file_id = "bench_payload.bin"
+    path = server.shard_path(file_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    chunk = os.urandom(1024 * 1024)
+    with open(path, "wb") as f:
+        for _ in range(SIZE_MB):
+            f.write(chunk)
+    return file_id
+
+def download(port, file_id):
+    conn = http.client.HTTPConnection("127.0.0.1", port)
+    conn.request("GET", f"/files/{file_id}")
+    resp = conn.getresponse()
+    buf = bytearray(1024 * 1024)
+    view = memoryview(buf)
+    received = 0
+    while True:
+        n = resp.readinto(view)
+        if not n:
+            break
+        received += n
+    conn.close()
+    return received
+
+def run(port, file_id, use_sendfile):
+    TimedHandler.use_sendfile = use_sendfile
+    server_cpu.clear()
+    total = 0
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        total += download(port, file_id)
+    elapsed = time.perf_counter() - start
+    gb = total / (1024 ** 3)
+    return {
+        "throughput_mb_s": (total / (1024 * 1024)) / elapsed,
+        "server_cpu_s_per_gb": sum(server_cpu) / gb if gb else 0.0,
+    }
+
+if __name__ == "__main__":
+    file_id = make_payload()
+    handler = lambda *args, **kwargs: TimedHandler(*args, directory=server.FILE_DIR, **kwargs)
+    httpd = socketserver.ThreadingTCPServer(("127.0.0.1", 0), handler)
+    httpd.daemon_threads = True
+    port = httpd.server_address[1]
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+
+    print(f"Payload: {SIZE_MB} MB x {ROUNDS} rounds (sendfile available: {server.USE_SENDFILE})")
+    modes = [("buffered copyfile", False)]
+    if server.USE_SENDFILE:
+        modes.append(("sendfile", True))
+    for label, use_sendfile in modes:
+        download(port, file_id)  # warm the page cache
+        r = run(port, file_id, use_sendfile)
+        print(f"{label:>18}: {r['throughput_mb_s']:8.1f} MB/s, "
+              f"server CPU {r['server_cpu_s_per_gb']:.3f} s/GB")
+
+    httpd.shutdown()
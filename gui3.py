@@ -3,41 +3,71 @@
 # Fixed: Friend Management Thread Safety, Data Persistence, Atomic Writes, Race Conditions
 
 import sys
+import time
+STARTUP_T0 = time.perf_counter()  # before the heavy imports, so the startup report includes them
 import os
 import json
 import socket
 import ssl
 import base64
 import traceback
-import requests
-import mimetypes
-import webbrowser
 import threading
 import shutil
+import sqlite3
+import uuid
+import hashlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
 from PyQt6.QtWidgets import (
     QApplication, QMainWindow, QWidget, QPushButton, QLabel, QVBoxLayout, QHBoxLayout,
     QListWidget, QListWidgetItem, QTextEdit, QLineEdit, QStackedWidget, QFileDialog,
-    QInputDialog, QMessageBox, QScrollArea, QFrame, QMenu, QGridLayout
+    QInputDialog, QMessageBox, QFrame, QMenu, QGridLayout, QProgressBar, QCheckBox,
+    QListView, QStyledItemDelegate, QAbstractItemView
+)
+from PyQt6.QtGui import QIcon, QPixmap, QImage, QAction, QFont, QPainter, QPainterPath, QColor, QFontMetrics
+from PyQt6.QtCore import (
+    Qt, QSize, QThread, QObject, pyqtSignal, QTimer, QPoint, QMimeData, QRect,
+    QAbstractListModel, QModelIndex
 )
-from PyQt6.QtGui import QIcon, QPixmap, QAction, QFont, QPainter, QPainterPath, QColor
-from PyQt6.QtCore import Qt, QSize, QThread, pyqtSignal, QTimer, QPoint, QMimeData
 
 # --- Configuration ---
 HOST = '192.168.29.114'
 PORT = 5000
 HTTP_PORT = 5001
-GLOBAL_CHAT_FILE = "chat_history.json"
+GLOBAL_CHAT_FILE = "chat_history.json"   # legacy store, imported into LOCAL_STORE_FILE once
+LOCAL_STORE_FILE = "chat_store.db"
 PROFILES_DIR = "profiles"
-GLOBAL_CHAT_LOCK = threading.Lock() 
+DOWNLOAD_CACHE_DIR = "download_cache"
 
 COLOR_BG = "#F5F5F0"
 COLOR_PANEL = "#E6D8C3"
 COLOR_ACCENT = "#5D866C"
 COLOR_DIVIDER = "#C2A68C"
 
-FRIENDS_REFRESH_INTERVAL_MS = 20_000
-PENDING_REFRESH_INTERVAL_MS = 20_000
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.gif', '.webp')
+THUMBNAIL_DISPLAY_SIZE = 160
+THUMBNAIL_RETRY_SECONDS = 300   # a file with no preview is not asked for again before this
+UPLOAD_CHUNK_SIZE = 64 * 1024
+HASH_CHUNK_SIZE = 1024 * 1024
+TRANSFER_WORKERS = 3            # concurrent uploads/downloads; the rest wait in the queue
+TRANSFER_MAX_RETRIES = 3
+TRANSFER_BACKOFF_SECONDS = 1.0  # doubled after every failed attempt
+TRANSFER_HISTORY_LIMIT = 5      # finished rows kept visible in the transfers panel
+BUBBLE_MAX_WIDTH = 480
+BUBBLE_PADDING = 10
+BUBBLE_RADIUS = 12
+MESSAGE_MARGIN_X = 8
+MESSAGE_MARGIN_Y = 4
+HISTORY_PAGE_SIZE = 200         # messages shown when a chat opens; older pages load on scroll-up
+FRAME_SEPARATOR = b"\x1e"       # ends every chat protocol message, must match server.py
+CLIENT_CAPS = "json,resume,ack"      # requested before LOGIN; the server echoes what it supports
+RECONNECT_BASE_DELAY = 1         # seconds before the first reconnect attempt, doubled after each failure
+RECONNECT_MAX_DELAY = 60
+UI_FRAME_MS = 16                # incoming bursts are rendered and scrolled at most once per frame
+AVATAR_CACHE_SIZE = 512         # rendered avatar icons/pixmaps kept in memory
+AVATAR_WORKERS = 2              # threads decoding profile pictures
 
 # Small SVG icons (base64)
 ACCEPT_SVG_B64 = base64.b64encode(b'''<svg xmlns="http://www.w3.org/2000/svg" width="24" height="24" viewBox="0 0 24 24">
@@ -55,29 +85,65 @@ def icon_from_base64(b64: str) -> QIcon:
     pix.loadFromData(data)
     return QIcon(pix)
 
+def friends_data_from_records(records: list) -> list:
+    """Server friend records ({"name", "online", "unread"}) in the shape the friends UI uses."""
+    return [{"name": r["name"], "online": bool(r.get("online")), "has_unread": r.get("unread", 0) > 0}
+            for r in records]
+
+def encode_frame(text: str) -> bytes:
+    return text.encode('utf-8').replace(FRAME_SEPARATOR, b"") + FRAME_SEPARATOR
+
+def decode_frame(data: bytes) -> str:
+    try:
+        return data.decode('utf-8')
+    except Exception:
+        return data.decode('latin-1')
+
 # Networking worker
 class ReceiverThread(QThread):
-    message_received = pyqtSignal(str)
+    """
+    Splits the socket stream into frames off the UI thread. Frames collect in
+    a pending list and messages_ready fires only when that list was empty, so
+    the UI takes whatever piled up in one go instead of one signal per message.
+    """
+    messages_ready = pyqtSignal()
     connection_error = pyqtSignal(str)
 
     def __init__(self, sock):
         super().__init__()
         self.sock = sock
         self.running = True
+        self.pending = []
+        self.pending_lock = threading.Lock()
+
+    def take_pending(self) -> list:
+        with self.pending_lock:
+            frames, self.pending = self.pending, []
+        return frames
 
     def run(self):
+        buffer = b""
         try:
             while self.running:
                 try:
-                    data = self.sock.recv(4096)
+                    data = self.sock.recv(65536)
                     if not data:
+                        if self.running:
+                            self.connection_error.emit("Connection closed by server")
                         break
-                    try:
-                        text = data.decode('utf-8')
-                    except Exception:
-                        text = data.decode('latin-1')
-                    self.message_received.emit(text)
-                except OSError:
+                    buffer += data
+                    *frames, buffer = buffer.split(FRAME_SEPARATOR)
+                    frames = [decode_frame(f) for f in frames if f]
+                    if not frames:
+                        continue
+                    with self.pending_lock:
+                        notify = not self.pending
+                        self.pending.extend(frames)
+                    if notify:
+                        self.messages_ready.emit()
+                except OSError as e:
+                    if self.running:
+                        self.connection_error.emit(str(e))
                     break
         except Exception as e:
             self.connection_error.emit(str(e))
@@ -91,6 +157,240 @@ class ReceiverThread(QThread):
         self.running = False
         self.wait(2000)
 
+# Transfers
+class TransferCancelled(Exception):
+    pass
+
+class UploadStream:
+    """
+    File-like request body that reads an upload from disk chunk by chunk,
+    reporting progress and aborting once cancel_event is set.
+    """
+
+    def __init__(self, path, on_progress=None, cancel_event=None):
+        self.total = os.path.getsize(path)
+        self.sent = 0
+        self.on_progress = on_progress
+        self.cancel_event = cancel_event
+        self._file = open(path, 'rb')
+
+    def __len__(self):
+        return self.total
+
+    def read(self, size=-1):
+        if self.cancel_event is not None and self.cancel_event.is_set():
+            raise TransferCancelled("Upload cancelled")
+        chunk = self._file.read(UPLOAD_CHUNK_SIZE if size is None or size < 0 else min(size, UPLOAD_CHUNK_SIZE))
+        self.sent += len(chunk)
+        if self.on_progress:
+            self.on_progress(self.sent, self.total)
+        return chunk
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class TransferRow(QWidget):
+    """One line in the transfers panel: name, progress bar and a cancel button."""
+    cancel_requested = pyqtSignal(str)
+
+    def __init__(self, transfer_id, label, parent=None):
+        super().__init__(parent)
+        self.transfer_id = transfer_id
+        h = QHBoxLayout(self)
+        h.setContentsMargins(4, 2, 4, 2)
+        self.name_label = QLabel(label)
+        self.name_label.setFont(QFont('Arial', 9))
+        self.progress = QProgressBar()
+        self.progress.setRange(0, 100)
+        self.progress.setFixedHeight(14)
+        self.cancel_btn = QPushButton("✕")
+        self.cancel_btn.setFixedSize(22, 22)
+        self.cancel_btn.setCursor(Qt.CursorShape.PointingHandCursor)
+        self.cancel_btn.setToolTip("Cancel transfer")
+        self.cancel_btn.clicked.connect(lambda: self.cancel_requested.emit(self.transfer_id))
+        h.addWidget(self.name_label)
+        h.addWidget(self.progress, 1)
+        h.addWidget(self.cancel_btn)
+
+    def set_progress(self, percent):
+        self.progress.setFormat("%p%")
+        self.progress.setValue(percent)
+
+    def set_state(self, state):
+        self.progress.setFormat(state)
+
+    def set_finished(self, status):
+        self.cancel_btn.hide()
+        self.progress.setFormat(status)
+
+def file_sha256(path: str, cancel_event=None) -> str:
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(HASH_CHUNK_SIZE):
+            if cancel_event is not None and cancel_event.is_set():
+                raise TransferCancelled("Upload cancelled")
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def is_retryable_transfer_error(e: Exception) -> bool:
+    import requests
+    if isinstance(e, (requests.ConnectionError, requests.Timeout)):
+        return True
+    if isinstance(e, requests.HTTPError) and e.response is not None:
+        return e.response.status_code >= 500
+    return False
+
+class TransferManager(QObject):
+    """
+    Runs uploads and downloads on a bounded worker pool that shares one pooled
+    HTTP session to the file server. Failed attempts are retried with
+    exponential backoff. Completion callbacks run on the worker thread.
+    """
+    transfer_queued = pyqtSignal(str, str)     # transfer_id, label
+    transfer_state = pyqtSignal(str, str)      # transfer_id, state text
+    transfer_progress = pyqtSignal(str, int)   # transfer_id, percent
+    transfer_finished = pyqtSignal(str, str)   # transfer_id, Done / Failed / Cancelled
+
+    def __init__(self, max_workers=TRANSFER_WORKERS):
+        super().__init__()
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="transfer")
+        self.max_workers = max_workers
+        self.session_lock = threading.Lock()
+        self._session = None
+        self.cancels = {}
+        self.hash_cache = {}  # (path, size, mtime) -> sha256
+
+    @property
+    def session(self):
+        """The pooled HTTP session; requests is imported on first use, not at startup."""
+        with self.session_lock:
+            if self._session is None:
+                import requests
+                session = requests.Session()
+                session.mount("http://", requests.adapters.HTTPAdapter(pool_connections=1,
+                                                                      pool_maxsize=self.max_workers))
+                self._session = session
+            return self._session
+
+    def content_hash(self, file_path: str, cancel_event=None) -> str:
+        st = os.stat(file_path)
+        key = (os.path.abspath(file_path), st.st_size, st.st_mtime_ns)
+        if key not in self.hash_cache:
+            self.hash_cache[key] = file_sha256(file_path, cancel_event)
+        return self.hash_cache[key]
+
+    def cancel(self, transfer_id: str):
+        event = self.cancels.get(transfer_id)
+        if event:
+            event.set()
+
+    def submit_upload(self, file_path: str, session_token: str, on_done=None, on_error=None) -> str:
+        filename = os.path.basename(file_path)
+        import mimetypes
+        mime_type, _ = mimetypes.guess_type(file_path)
+        headers = {
+            'X-Filename': filename,
+            'X-Session-Token': session_token or '',  # the server charges the upload to this login
+            'Content-Type': mime_type or 'application/octet-stream',
+        }
+
+        def attempt(cancel_event, on_progress):
+            # Hash-first: if the server already stores these bytes, reuse that file
+            sha256 = self.content_hash(file_path, cancel_event)
+            response = self.session.get(f"http://{HOST}:{HTTP_PORT}/hash/{sha256}", timeout=15)
+            response.raise_for_status()
+            known = response.json()
+            if known.get("exists"):
+                on_progress(1, 1)
+                return {
+                    "success": True,
+                    "file_id": known["file_id"],
+                    "filename": filename,
+                    "url": known["url"],
+                    "deduplicated": True
+                }
+
+            headers['X-Content-SHA256'] = sha256
+            with UploadStream(file_path, on_progress, cancel_event) as body:
+                # requests needs a bytes body to send Content-Length: 0 for empty files
+                response = self.session.post(f"http://{HOST}:{HTTP_PORT}/", data=body if len(body) else b"",
+                                             headers=headers, timeout=300)
+            response.raise_for_status()
+            data = response.json()
+            if not data.get("success"):
+                raise Exception(data.get("error", "Unknown upload error"))
+            return data
+
+        return self._submit(f"⬆ {filename}", attempt, on_done, on_error)
+
+    def submit_download(self, url: str, cache_key: str, label: str, on_done=None, on_error=None) -> str:
+        def attempt(cancel_event, on_progress):
+            path, _ = cached_download(url, cache_key, timeout=60, session=self.session,
+                                      on_progress=on_progress, cancel_event=cancel_event)
+            if not path:
+                raise Exception("the file is no longer on the server")
+            return path
+
+        return self._submit(f"⬇ {label}", attempt, on_done, on_error)
+
+    def _submit(self, label, attempt, on_done, on_error) -> str:
+        transfer_id = uuid.uuid4().hex
+        self.cancels[transfer_id] = threading.Event()
+        self.transfer_queued.emit(transfer_id, label)
+        self.pool.submit(self._run, transfer_id, attempt, on_done, on_error)
+        return transfer_id
+
+    def _run(self, transfer_id, attempt, on_done, on_error):
+        cancel_event = self.cancels[transfer_id]
+        last_percent = [-1]
+
+        def on_progress(done, total):
+            percent = int(done * 100 / total) if total else 100
+            if percent != last_percent[0]:
+                last_percent[0] = percent
+                self.transfer_progress.emit(transfer_id, percent)
+
+        try:
+            for attempt_no in range(TRANSFER_MAX_RETRIES + 1):
+                if cancel_event.is_set():
+                    raise TransferCancelled("Transfer cancelled")
+                self.transfer_state.emit(transfer_id, "Active" if attempt_no == 0 else f"Retry {attempt_no}")
+                try:
+                    result = attempt(cancel_event, on_progress)
+                    break
+                except Exception as e:
+                    if cancel_event.is_set():
+                        raise TransferCancelled("Transfer cancelled") from e
+                    if attempt_no == TRANSFER_MAX_RETRIES or not is_retryable_transfer_error(e):
+                        raise
+                    delay = TRANSFER_BACKOFF_SECONDS * (2 ** attempt_no)
+                    print(f"Transfer attempt {attempt_no + 1} failed ({e}); retrying in {delay:g}s")
+                    self.transfer_state.emit(transfer_id, f"Retrying in {delay:g}s")
+                    if cancel_event.wait(delay):
+                        raise TransferCancelled("Transfer cancelled")
+        except TransferCancelled as e:
+            self.transfer_finished.emit(transfer_id, "Cancelled")
+            if on_error:
+                on_error(e)
+            return
+        except Exception as e:
+            self.transfer_finished.emit(transfer_id, "Failed")
+            if on_error:
+                on_error(e)
+            return
+        finally:
+            self.cancels.pop(transfer_id, None)
+
+        self.transfer_finished.emit(transfer_id, "Done")
+        if on_done:
+            on_done(result)
+
 # Persistence utils
 def ensure_profiles_dir():
     try:
@@ -114,26 +414,182 @@ def load_global_chat_history():
         print(f"Warning: Failed to load chat history ({e}). Returning None to signal failure.")
         return None
 
-def save_global_chat_history(data: dict):
+class LocalMessageStore:
     """
-    Atomic write to prevent file corruption during crashes or race conditions.
+    Client message log in SQLite. Each client appends the messages of its own
+    user (owner) only, and the (owner, peer, msg_id) key makes re-deliveries
+    of the same message a no-op.
     """
-    tmp_file = GLOBAL_CHAT_FILE + ".tmp"
-    try:
-        with open(tmp_file, 'w') as f:
-            json.dump(data, f, indent=2)
-            f.flush()
-            os.fsync(f.fileno()) # Ensure write to disk
-        
-        # Atomic replace
-        shutil.move(tmp_file, GLOBAL_CHAT_FILE)
-    except Exception as e:
-        print("Failed to write global chat file:", e)
-        if os.path.exists(tmp_file):
+    def __init__(self, path: str):
+        self.lock = threading.RLock()
+        self.batch_depth = 0
+        self.conn = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS messages (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    owner TEXT NOT NULL,
+                    peer TEXT NOT NULL,
+                    msg_id TEXT NOT NULL,
+                    sender TEXT NOT NULL,
+                    message TEXT NOT NULL,
+                    timestamp TEXT NOT NULL,
+                    UNIQUE (owner, peer, msg_id)
+                )""")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS messages_by_conversation ON messages (owner, peer, seq)")
+            # one row per conversation, so listing chats at startup does not scan the message log
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS chats (
+                    owner TEXT NOT NULL,
+                    peer TEXT NOT NULL,
+                    last_seq INTEGER NOT NULL,
+                    last_timestamp TEXT NOT NULL,
+                    PRIMARY KEY (owner, peer)
+                )""")
+            if self.conn.execute("SELECT 1 FROM chats LIMIT 1").fetchone() is None:
+                self._rebuild_chats()
+
+    def _rebuild_chats(self):
+        self.conn.execute("INSERT OR REPLACE INTO chats (owner, peer, last_seq, last_timestamp) "
+                          "SELECT owner, peer, MAX(seq), timestamp FROM messages GROUP BY owner, peer")
+
+    def add(self, owner: str, peer: str, msg_id: str, sender: str, message: str, timestamp: str = None) -> bool:
+        """Appends one message. Returns False if owner already has msg_id."""
+        timestamp = timestamp or datetime.now().isoformat()
+        with self.lock:
+            cur = self.conn.execute(
+                "INSERT OR IGNORE INTO messages (owner, peer, msg_id, sender, message, timestamp) "
+                "VALUES (?, ?, ?, ?, ?, ?)", (owner, peer, msg_id, sender, message, timestamp))
+            if cur.rowcount == 1:
+                self.conn.execute(
+                    "INSERT INTO chats (owner, peer, last_seq, last_timestamp) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT (owner, peer) DO UPDATE SET last_seq = excluded.last_seq, "
+                    "last_timestamp = excluded.last_timestamp", (owner, peer, cur.lastrowid, timestamp))
+            if not self.batch_depth:
+                self.conn.commit()
+        return cur.rowcount == 1
+
+    @contextmanager
+    def batch(self):
+        """Commits every add() inside the block as one transaction."""
+        with self.lock:
+            self.batch_depth += 1
             try:
+                yield self
+            finally:
+                self.batch_depth -= 1
+                if not self.batch_depth:
+                    self.conn.commit()
+
+    def conversation_page(self, owner: str, peer: str, before_seq: int = None, limit: int = HISTORY_PAGE_SIZE) -> list:
+        """
+        The last limit messages before before_seq (default: the newest), oldest first.
+        Read backwards along the (owner, peer, seq) index, so the cost does not grow
+        with the length of the conversation.
+        """
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT seq, msg_id, sender, message, timestamp FROM messages "
+                "WHERE owner = ? AND peer = ? AND seq < ? ORDER BY seq DESC LIMIT ?",
+                (owner, peer, before_seq if before_seq is not None else 2 ** 63 - 1, limit)).fetchall()
+        return [{"seq": r[0], "id": r[1], "sender": r[2], "message": r[3], "timestamp": r[4]} for r in reversed(rows)]
+
+    def recent_peers(self, owner: str) -> list:
+        """(peer, timestamp of the last message) for every conversation, most recent first."""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT peer, last_timestamp FROM chats WHERE owner = ? ORDER BY last_seq DESC", (owner,)).fetchall()
+        return [(r[0], r[1]) for r in rows]
+
+    def clear(self, owner: str, peer: str):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM messages WHERE (owner = ? AND peer = ?) OR (owner = ? AND peer = ?)",
+                              (owner, peer, peer, owner))
+            self.conn.execute("DELETE FROM chats WHERE (owner = ? AND peer = ?) OR (owner = ? AND peer = ?)",
+                              (owner, peer, peer, owner))
+
+    def import_json_history(self, path: str):
+        """One-time import of the old chat_history.json; the file is kept as <name>.migrated."""
+        if not os.path.exists(path):
+            return
+        data = load_global_chat_history()
+        if data is None:
+            return  # unreadable; leave it for the next start instead of losing it
+        with self.lock, self.conn:
+            for owner, convs in data.items():
+                for peer, entries in convs.items():
+                    self.conn.executemany(
+                        "INSERT OR IGNORE INTO messages (owner, peer, msg_id, sender, message, timestamp) "
+                        "VALUES (?, ?, ?, ?, ?, ?)",
+                        [(owner, peer, e.get("id") or f"legacy-{i}", e.get("sender", ""), e.get("message", ""),
+                          e.get("timestamp") or "") for i, e in enumerate(entries)])
+            self._rebuild_chats()
+        os.replace(path, path + ".migrated")
+        print(f"Imported {path} into {LOCAL_STORE_FILE}")
+
+def cached_download(url: str, cache_key: str, timeout: int = 30, session=None,
+                    on_progress=None, cancel_event=None):
+    """
+    Fetches url into the on-disk download cache, revalidating any cached copy
+    with If-None-Match / If-Modified-Since so an unchanged resource costs one
+    round trip with no body. Returns (path, modified); path is None on 404.
+    """
+    os.makedirs(DOWNLOAD_CACHE_DIR, exist_ok=True)
+    body_path = os.path.join(DOWNLOAD_CACHE_DIR, os.path.basename(cache_key))
+    meta_path = body_path + ".meta.json"
+
+    meta = {}
+    if os.path.exists(body_path) and os.path.exists(meta_path):
+        try:
+            with open(meta_path, 'r') as f:
+                meta = json.load(f)
+        except (json.JSONDecodeError, OSError):
+            meta = {}
+    headers = {}
+    if meta.get("etag"):
+        headers["If-None-Match"] = meta["etag"]
+    if meta.get("last_modified"):
+        headers["If-Modified-Since"] = meta["last_modified"]
+
+    if session is None:
+        import requests
+        session = requests
+    http = session
+    with http.get(url, headers=headers, stream=True, timeout=timeout) as response:
+        if response.status_code == 304:
+            return body_path, False
+        if response.status_code == 404:
+            return None, False
+        response.raise_for_status()
+
+        total = int(response.headers.get("Content-Length") or 0)
+        tmp_file = f"{body_path}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_file, 'wb') as f:
+                for chunk in response.iter_content(chunk_size=65536):
+                    if cancel_event is not None and cancel_event.is_set():
+                        raise TransferCancelled("Download cancelled")
+                    f.write(chunk)
+                    if on_progress:
+                        on_progress(response.raw.tell(), total)
+            os.replace(tmp_file, body_path)
+        except BaseException:
+            if os.path.exists(tmp_file):
                 os.remove(tmp_file)
-            except:
-                pass
+            raise
+        with open(meta_path, 'w') as f:
+            json.dump({
+                "url": url,
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified")
+            }, f)
+    return body_path, True
+
+def thumbnail_url_for(file_url: str) -> str:
+    """The file server exposes image previews at /thumbs/<file_id> next to /files/<file_id>."""
+    return file_url.replace("/files/", "/thumbs/", 1)
 
 # Helpers for circular avatars + online dot
 def circular_pixmap(source: QPixmap, size: int) -> QPixmap:
@@ -167,8 +623,301 @@ def avatar_icon_for(nickname: str, pixmap: QPixmap, size: int = 32, online: bool
     painter.end()
     return QIcon(base)
 
+def decode_avatar(nickname: str):
+    """Finds and decodes a profile picture off the UI thread. Returns (QImage, mtime_ns) or (None, None)."""
+    for ext in ('.png', '.jpg'):
+        path = os.path.join(PROFILES_DIR, f"{nickname}{ext}")
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            continue
+        image = QImage(path)
+        if not image.isNull():
+            return image, mtime
+    return None, None
+
+class AvatarCache:
+    """LRU of rendered avatars. Keys carry the image mtime, so a replaced picture never hits a stale entry."""
+    def __init__(self, max_entries: int = AVATAR_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+
+    def get(self, key, render):
+        value = self.entries.get(key)
+        if value is not None:
+            self.entries.move_to_end(key)
+            return value
+        value = render()
+        self.entries[key] = value
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return value
+
+# --- Message list (virtualized) ---
+def format_timestamp(timestamp) -> str:
+    """History stores ISO timestamps, live messages arrive as HH:MM."""
+    if isinstance(timestamp, str) and ':' in timestamp and len(timestamp) <= 5:
+        return timestamp
+    try:
+        return datetime.fromisoformat(timestamp).strftime('%H:%M')
+    except Exception:
+        return datetime.now().strftime('%H:%M')
+
+def parse_file_message(text: str):
+    """Returns (file_id, file_name, file_url) for FILE| messages, otherwise None."""
+    if not text.startswith("FILE|"):
+        return None
+    parts = text.split("|", 3)
+    if len(parts) != 4:
+        return None
+    return tuple(parts[1:])
+
+def make_message_row(text: str, incoming: bool, timestamp) -> dict:
+    return {"text": text, "incoming": incoming, "timestamp": timestamp, "file": parse_file_message(text)}
+
+class MessageListModel(QAbstractListModel):
+    """Plain message rows; the delegate paints them only when they scroll into view."""
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.rows = []
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+        row = self.rows[index.row()]
+        if role == Qt.ItemDataRole.DisplayRole:
+            return row["text"]
+        if role == Qt.ItemDataRole.ToolTipRole and row["file"]:
+            return f"Click to download '{row['file'][1]}'"
+        return None
+
+    def row_at(self, index) -> dict:
+        """The row dict itself; going through data() would hand back a converted copy."""
+        return self.rows[index.row()]
+
+    def set_messages(self, rows):
+        self.beginResetModel()
+        self.rows = list(rows)
+        self.endResetModel()
+
+    def append_message(self, row: dict):
+        n = len(self.rows)
+        self.beginInsertRows(QModelIndex(), n, n)
+        self.rows.append(row)
+        self.endInsertRows()
+
+    def prepend_messages(self, rows):
+        if not rows:
+            return
+        self.beginInsertRows(QModelIndex(), 0, len(rows) - 1)
+        self.rows[:0] = rows
+        self.endInsertRows()
+
+    def clear(self):
+        self.set_messages([])
+
+    def rows_for_file(self, file_id: str):
+        """Indexes of the rows showing file_id; their cached layout is dropped so they get re-measured."""
+        indexes = []
+        for i, row in enumerate(self.rows):
+            if row["file"] and row["file"][0] == file_id:
+                row.pop("layout", None)
+                indexes.append(self.index(i))
+        return indexes
+
+# --- Chat list (indexed) ---
+CHAT_NAME_ROLE = Qt.ItemDataRole.UserRole + 1
+CHAT_UNREAD_ROLE = Qt.ItemDataRole.UserRole + 2
+CHAT_ONLINE_ROLE = Qt.ItemDataRole.UserRole + 3
+CHAT_ACTIVITY_ROLE = Qt.ItemDataRole.UserRole + 4
+
+def activity_time(timestamp) -> float:
+    """Epoch seconds of a stored ISO timestamp; 0 for legacy rows without one."""
+    try:
+        return datetime.fromisoformat(timestamp).timestamp()
+    except Exception:
+        return 0.0
+
+class ChatListModel(QAbstractListModel):
+    """
+    One row per conversation, most recently active first. Rows are found
+    through the name -> row index, so an update touches only its own row.
+    """
+    def __init__(self, icon_for, parent=None):
+        super().__init__(parent)
+        self.icon_for = icon_for  # (name, online) -> QIcon
+        self.entries = []         # {"name", "unread", "online", "last_activity"}
+        self.rows = {}            # name -> row in entries
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.entries)
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+        entry = self.entries[index.row()]
+        if role == Qt.ItemDataRole.DisplayRole:
+            return f"{entry['name']} ({entry['unread']})" if entry["unread"] else entry["name"]
+        if role == Qt.ItemDataRole.DecorationRole:
+            return self.icon_for(entry["name"], entry["online"])
+        if role == CHAT_NAME_ROLE:
+            return entry["name"]
+        if role == CHAT_UNREAD_ROLE:
+            return entry["unread"]
+        if role == CHAT_ONLINE_ROLE:
+            return entry["online"]
+        if role == CHAT_ACTIVITY_ROLE:
+            return entry["last_activity"]
+        return None
+
+    def row_of(self, name: str) -> int:
+        return self.rows.get(name, -1)
+
+    def name_at(self, index) -> str | None:
+        return self.entries[index.row()]["name"] if index.isValid() else None
+
+    def set_chats(self, chats):
+        """chats: (name, last_activity) pairs, most recent first."""
+        self.beginResetModel()
+        self.entries = [{"name": name, "unread": 0, "online": False, "last_activity": when} for name, when in chats]
+        self.rows = {entry["name"]: i for i, entry in enumerate(self.entries)}
+        self.endResetModel()
+
+    def ensure(self, name: str) -> int:
+        """Row of name, appending a chat with no activity yet if it is new."""
+        row = self.rows.get(name)
+        if row is None:
+            row = len(self.entries)
+            self.beginInsertRows(QModelIndex(), row, row)
+            self.entries.append({"name": name, "unread": 0, "online": False, "last_activity": 0.0})
+            self.rows[name] = row
+            self.endInsertRows()
+        return row
+
+    def update(self, name: str, **fields):
+        row = self.ensure(name)
+        entry = self.entries[row]
+        if any(entry[k] != v for k, v in fields.items()):
+            entry.update(fields)
+            self.dataChanged.emit(self.index(row), self.index(row))
+
+    def touch(self, name: str, when: float):
+        """Records activity and moves the chat to the top."""
+        row = self.ensure(name)
+        self.entries[row]["last_activity"] = when
+        if row == 0:
+            self.dataChanged.emit(self.index(0), self.index(0))
+            return
+        self.beginMoveRows(QModelIndex(), row, row, QModelIndex(), 0)
+        self.entries.insert(0, self.entries.pop(row))
+        for i in range(row + 1):
+            self.rows[self.entries[i]["name"]] = i
+        self.endMoveRows()
+
+    def refresh(self, names):
+        """Repaints the rows of names, e.g. after their avatar finished decoding."""
+        for name in names:
+            row = self.rows.get(name)
+            if row is not None:
+                self.dataChanged.emit(self.index(row), self.index(row), [Qt.ItemDataRole.DecorationRole])
+
+class MessageDelegate(QStyledItemDelegate):
+    """Paints chat bubbles straight onto the list viewport instead of building widgets per message."""
+    def __init__(self, thumbnail_for, request_thumbnail, parent=None):
+        super().__init__(parent)
+        self.thumbnail_for = thumbnail_for
+        self.request_thumbnail = request_thumbnail
+        self.time_font = QFont('Arial', 8)
+        self.time_height = QFontMetrics(self.time_font).height()
+        self.metrics = {}  # font key -> QFontMetrics
+
+    def is_image(self, row: dict) -> bool:
+        return bool(row["file"]) and row["file"][1].lower().endswith(IMAGE_EXTENSIONS)
+
+    def label_for(self, row: dict) -> str:
+        if not row["file"]:
+            return row["text"]
+        return row["file"][1] if self.is_image(row) else f"📄 {row['file'][1]}"
+
+    def layout_for(self, row: dict, width: int, font: QFont):
+        """Measures a row once per view width (and thumbnail state) and caches the result on the row."""
+        thumb = self.thumbnail_for(row["file"][0]) if self.is_image(row) else None
+        key = (width, thumb is not None)
+        cached = row.get("layout")
+        if cached and cached[0] == key:
+            return cached[1]
+
+        label = self.label_for(row)
+        max_text = max(40, min(BUBBLE_MAX_WIDTH, width - 2 * MESSAGE_MARGIN_X) - 2 * BUBBLE_PADDING)
+        metrics = self.metrics.get(font.key())
+        if metrics is None:
+            metrics = self.metrics[font.key()] = QFontMetrics(font)
+        text_rect = metrics.boundingRect(QRect(0, 0, max_text, 100000), Qt.TextFlag.TextWordWrap, label)
+        content_w, content_h = text_rect.width(), text_rect.height()
+        if thumb is not None:
+            content_w = max(content_w, thumb.width())
+            content_h += thumb.height() + 4
+        layout = {
+            "label": label,
+            "thumb": thumb,
+            "bubble": QSize(content_w + 2 * BUBBLE_PADDING, content_h + 2 * BUBBLE_PADDING),
+        }
+        row["layout"] = (key, layout)
+        return layout
+
+    def view_width(self, option) -> int:
+        view = self.parent()
+        return view.viewport().width() if view is not None else option.rect.width()
+
+    def sizeHint(self, option, index):
+        width = self.view_width(option)
+        layout = self.layout_for(index.model().row_at(index), width, option.font)
+        return QSize(layout["bubble"].width() + 2 * MESSAGE_MARGIN_X,
+                     layout["bubble"].height() + self.time_height + 2 * MESSAGE_MARGIN_Y)
+
+    def paint(self, painter, option, index):
+        row = index.model().row_at(index)
+        width = self.view_width(option)
+        layout = self.layout_for(row, width, option.font)
+        incoming = row["incoming"]
+        size = layout["bubble"]
+        if incoming:
+            x = option.rect.left() + MESSAGE_MARGIN_X
+        else:
+            x = option.rect.left() + width - MESSAGE_MARGIN_X - size.width()
+        bubble = QRect(x, option.rect.top() + MESSAGE_MARGIN_Y, size.width(), size.height())
+
+        painter.save()
+        painter.setRenderHint(QPainter.RenderHint.Antialiasing)
+        painter.setPen(Qt.PenStyle.NoPen)
+        painter.setBrush(QColor(COLOR_PANEL if incoming else COLOR_ACCENT))
+        painter.drawRoundedRect(bubble, BUBBLE_RADIUS, BUBBLE_RADIUS)
+
+        content = bubble.adjusted(BUBBLE_PADDING, BUBBLE_PADDING, -BUBBLE_PADDING, -BUBBLE_PADDING)
+        thumb = layout["thumb"]
+        if thumb is None and self.is_image(row):
+            self.request_thumbnail(row["file"][0], row["file"][2])  # only rows that get painted fetch previews
+        if thumb is not None:
+            painter.drawPixmap(content.topLeft(), thumb)
+            content.setTop(content.top() + thumb.height() + 4)
+        painter.setPen(QColor('black' if incoming else 'white'))
+        painter.setFont(option.font)
+        painter.drawText(content, Qt.TextFlag.TextWordWrap | Qt.AlignmentFlag.AlignLeft | Qt.AlignmentFlag.AlignTop,
+                         layout["label"])
+
+        painter.setPen(QColor('#666'))
+        painter.setFont(self.time_font)
+        if "time" not in row:
+            row["time"] = format_timestamp(row["timestamp"])
+        painter.drawText(QRect(bubble.left(), bubble.bottom() + 1, bubble.width(), self.time_height),
+                         Qt.AlignmentFlag.AlignRight, row["time"])
+        painter.restore()
+
 class FileManiaWindow(QWidget):
-    file_action_signal = pyqtSignal(str, str) 
+    file_action_signal = pyqtSignal(str, str, bool)
 
     def __init__(self, parent=None):
         super().__init__(parent)
@@ -205,6 +954,8 @@ class FileManiaWindow(QWidget):
         grid_layout.addWidget(self.btn_summarize, 0, 0)
         grid_layout.addWidget(self.btn_find_info, 0, 1)
         grid_layout.addWidget(self.btn_generate_report, 1, 0, 1, 2)
+        self.force_rerun = QCheckBox("Re-run analysis (ignore cached result)")
+        grid_layout.addWidget(self.force_rerun, 2, 0, 1, 2)
         self.cancel_button = QPushButton("Cancel")
         self.cancel_button.setStyleSheet("""
             background-color: #d9534f;
@@ -254,26 +1005,53 @@ class FileManiaWindow(QWidget):
             QMessageBox.warning(self, "Error", "Please drop a file into the window first.")
             return
 
-        self.file_action_signal.emit(self.file_path, action)
+        self.file_action_signal.emit(self.file_path, action, self.force_rerun.isChecked())
+        self.force_rerun.setChecked(False)
         self.file_path = None
         self.file_label.setText("Drag & Drop File Here")
         self.drop_zone.setStyleSheet("border: 2px dashed #AAA; border-radius: 10px; padding: 20px;")
         self.update_button_states(False)
         self.close()
 
+# --- Startup timing ---
+class StartupTimer:
+    """Wall-clock breakdown from process start to a usable window, printed once."""
+    def __init__(self, t0: float):
+        self.t0 = t0
+        self.last = t0
+        self.stages = []
+
+    def mark(self, stage: str):
+        now = time.perf_counter()
+        self.stages.append((stage, now - self.last))
+        self.last = now
+
+    def report(self):
+        print(f"[startup] usable after {(self.last - self.t0) * 1000:.0f} ms")
+        for stage, seconds in self.stages:
+            print(f"[startup]   {stage:<24}{seconds * 1000:8.1f} ms")
+
 # Main app
 class AgenticChatApp(QMainWindow):
 
     # --- SIGNALS ---
     ui_message_signal = pyqtSignal(str, bool, str)
+    conversation_message_signal = pyqtSignal(str, str, bool, str)  # friend, text, incoming, timestamp
     ai_indicator_signal = pyqtSignal(str, bool)
-    add_chat_list_item_signal = pyqtSignal(str, QIcon)
     # New signals for thread-safe Friend/Pending updates
     friends_list_data_signal = pyqtSignal(list)
     pending_list_data_signal = pyqtSignal(list)
+    thumbnail_ready_signal = pyqtSignal(str, bytes)
+    download_finished_signal = pyqtSignal(str, str, str)  # file name, save path, error
+    avatar_decoded_signal = pyqtSignal(str, object, object)  # nickname, QImage or None, mtime_ns
+    avatar_changed_signal = pyqtSignal(str)
+    reconnected_signal = pyqtSignal(object)  # new logged-in-pending socket, or None if the attempt failed
+    outgoing_frame_signal = pyqtSignal(str, str)  # frame, msg_id of a chat message or ""
 
     def __init__(self):
         super().__init__()
+        self.startup = StartupTimer(STARTUP_T0)
+        self.startup.mark("imports")
         self.setWindowTitle("Connect")
         self.setGeometry(100, 100, 1300, 750)
         self.setStyleSheet(f"background-color: {COLOR_BG};")
@@ -288,25 +1066,96 @@ class AgenticChatApp(QMainWindow):
         self.user_profile_file = None
         
         self.chat_file = None 
-        self.global_history = {}
-        self.unread_local = {}
+        self.store = None
+        self.unread_local = {}        # friend -> unread message count
+        self.pending_reads = {}       # friend -> last msg_id that arrived in the open chat this batch
+        self.conversations = {}       # friend -> message rows loaded so far (newest pages), kept current
+        self.oldest_seq = {}          # friend -> store seq of the first loaded row; None once all are loaded
+        self.open_conversation = None
+        self.history_offset = 0       # index in conversations[open_conversation] of the first row on screen
 
         self.awaiting_friends = False
         self.awaiting_pending = False
         self.pending_entries = []
         self.profile_pics = {}
+        self.avatar_mtimes = {}       # nickname -> mtime_ns of the loaded picture, part of the render cache key
+        self.missing_avatars = set()  # nicknames with no picture on disk; not probed again until synced
+        self.avatar_cache = AvatarCache()
+        self.avatar_pool = ThreadPoolExecutor(max_workers=AVATAR_WORKERS)
+        self.avatar_loading = set()   # nicknames queued on avatar_pool
+        self.avatar_refresh = set()   # nicknames whose list icons need repainting
+        self.friend_online = {}       # nickname -> online, kept current by presence events
+        self.friends_data = []        # last friends list shown, as {"name", "online", "has_unread"}
+        self.server_caps = set()      # formats the server agreed to in LOGIN_OK
+        self.resume_token = None      # lets a reconnect skip the password login, see RESUME
+        self.http_token = None        # file-server credential from LOGIN_OK, sent as X-Session-Token
+        self.reconnect_attempts = 0
+        self.reconnecting = False     # an attempt is scheduled or in flight
+        self.pending_acks = {}        # sender -> last msg_id stored in this batch
+        self.session_ready = False    # logged in on the current socket; writes wait until then
+        self.outbox = OrderedDict()   # msg_id -> PRIVATE_ID frame, kept until the server answers SENT or REJECTED
+        self.write_queue = []         # frames for the next socket write
+        self.write_timer = QTimer(self)
+        self.write_timer.setSingleShot(True)
+        self.write_timer.timeout.connect(self.flush_writes)
+        self.outgoing_frame_signal.connect(self.enqueue_frame)
+        self.pending_avatar_labels = {}
+        self.avatar_refresh_timer = QTimer(self)
+        self.avatar_refresh_timer.setSingleShot(True)
+        self.avatar_refresh_timer.timeout.connect(self.refresh_avatar_icons)
+        # connected before prompt_and_connect: the chat list queues decodes while it is built
+        self.avatar_decoded_signal.connect(self.on_avatar_decoded)
+        self.avatar_changed_signal.connect(self.on_avatar_changed)
         self.auto_active = set()
         self.ai_running = set()
+        self.thumbnails = {}          # file_id -> QPixmap preview
+        self.thumbnail_waiters = set()  # file_ids with a preview fetch in flight
+        self.thumbnail_failures = {}  # file_id -> monotonic time its preview fetch failed
+        self.avatars_synced = set()
+        self.transfers = TransferManager()
+        self.transfer_rows = {}       # transfer_id -> TransferRow
+        self.transfer_states = {}     # transfer_id -> Queued / Active / Done ...
+        self.finished_transfer_rows = []
 
         self.init_ui()
+        self.startup.mark("build window")
         self.prompt_and_connect()
         
         # Connect Signals
         self.ui_message_signal.connect(self.add_message_to_view)
-        self.add_chat_list_item_signal.connect(self.on_add_chat_list_item)
+        self.conversation_message_signal.connect(self.on_conversation_message)
         self.ai_indicator_signal.connect(self.update_ai_indicator)
         self.friends_list_data_signal.connect(self.on_update_friends_ui)
         self.pending_list_data_signal.connect(self.on_update_pending_ui)
+        self.thumbnail_ready_signal.connect(self.on_thumbnail_ready)
+        self.transfers.transfer_queued.connect(self.on_transfer_queued)
+        self.transfers.transfer_state.connect(self.on_transfer_state)
+        self.transfers.transfer_progress.connect(self.on_transfer_progress)
+        self.transfers.transfer_finished.connect(self.on_transfer_finished)
+        self.download_finished_signal.connect(self.on_download_finished)
+        self.reconnected_signal.connect(self.on_reconnected)
+
+        # runs once the event loop has shown the window; the login round trip is already in flight
+        QTimer.singleShot(0, self.finish_startup)
+
+    def finish_startup(self):
+        """Second startup stage: local history, chat list and profile, then start reading from the server."""
+        self.startup.mark("show window")
+        self.store.import_json_history(GLOBAL_CHAT_FILE)
+        self.startup.mark("local history")
+        self.refresh_chat_list_from_history()
+        self.startup.mark("chat list")
+        self.load_profile_info()
+        self.load_own_profile_pic()
+        self.startup.mark("own profile")
+        if self.sock:
+            # started only now, so incoming messages land in a fully built chat list
+            self.start_receiver()
+        else:
+            self.schedule_reconnect()
+        self.startup.report()
+        # warm the HTTP stack for the first avatar sync or transfer off the UI thread
+        threading.Thread(target=lambda: self.transfers.session, daemon=True).start()
 
     def init_ui(self):
         main_layout = QHBoxLayout()
@@ -360,11 +1209,6 @@ class AgenticChatApp(QMainWindow):
         main_layout.addWidget(self.stacked_widget, 3)
         main_layout.addWidget(self.ai_display, 1)
 
-        self.friends_timer = QTimer(self)
-        self.friends_timer.timeout.connect(self.request_friends_list)
-        self.pending_timer = QTimer(self)
-        self.pending_timer.timeout.connect(self.request_pending_list)
-
     def create_chat_page(self):
         page = QWidget()
         layout = QHBoxLayout(page)
@@ -382,21 +1226,28 @@ class AgenticChatApp(QMainWindow):
         pix.fill(Qt.GlobalColor.transparent)
         self.search_icon.setPixmap(pix)
         self.search_bar = QLineEdit()
-        self.search_bar.setPlaceholderText("Search chats…")
+        self.search_bar.setPlaceholderText("Search chats… (Enter searches messages)")
         self.search_bar.setStyleSheet(f"background-color: {COLOR_PANEL}; border: 1px solid {COLOR_DIVIDER}; border-radius: 15px; padding: 8px 12px;")
         search_container.addWidget(self.search_icon)
         search_container.addWidget(self.search_bar)
 
         left_layout.addLayout(search_container)
 
-        self.chat_list = QListWidget()
-        self.chat_list.setStyleSheet(f"QListWidget::item{{padding:10px; border-bottom:1px solid {COLOR_DIVIDER};}} QListWidget::item:selected{{background-color:{COLOR_ACCENT}; color:white;}}")
+        self.chat_model = ChatListModel(lambda name, online: self.avatar_icon(name, 28, online), self)
+        self.chat_list = QListView()
+        self.chat_list.setModel(self.chat_model)
+        self.chat_list.setEditTriggers(QAbstractItemView.EditTrigger.NoEditTriggers)
+        self.chat_list.setStyleSheet(f"QListView::item{{padding:10px; border-bottom:1px solid {COLOR_DIVIDER};}} QListView::item:selected{{background-color:{COLOR_ACCENT}; color:white;}}")
         left_layout.addWidget(self.chat_list)
-        self.chat_list.itemClicked.connect(self.on_chat_selected)
+        self.chat_list.clicked.connect(self.on_chat_selected)
         self.chat_list.setContextMenuPolicy(Qt.ContextMenuPolicy.CustomContextMenu)
         self.chat_list.customContextMenuRequested.connect(self.on_chat_context_menu)
 
         self.search_bar.textChanged.connect(self.filter_chats)
+        # hidden flags follow rows as touch() moves them; only new rows and a reset need the filter
+        self.chat_model.rowsInserted.connect(lambda parent, first, last: self.filter_rows(first, last))
+        self.chat_model.modelReset.connect(self.filter_chats)
+        self.search_bar.returnPressed.connect(self.search_messages)
 
         right_container = QWidget()
         right_layout = QVBoxLayout(right_container)
@@ -416,12 +1267,22 @@ class AgenticChatApp(QMainWindow):
         ch_layout.addStretch()
         self.chat_header.hide()
 
-        self.conversation_area = QScrollArea()
-        self.conversation_area.setWidgetResizable(True)
-        self.chat_widget = QWidget()
-        self.chat_layout = QVBoxLayout(self.chat_widget)
-        self.chat_layout.setAlignment(Qt.AlignmentFlag.AlignTop)
-        self.conversation_area.setWidget(self.chat_widget)
+        self.message_model = MessageListModel(self)
+        self.message_view = QListView()
+        self.message_view.setModel(self.message_model)
+        self.message_view.setItemDelegate(MessageDelegate(self.thumbnails.get, self.request_thumbnail,
+                                                          self.message_view))
+        self.message_view.setResizeMode(QListView.ResizeMode.Adjust)
+        self.message_view.setHorizontalScrollBarPolicy(Qt.ScrollBarPolicy.ScrollBarAlwaysOff)
+        self.message_view.setSelectionMode(QAbstractItemView.SelectionMode.NoSelection)
+        self.message_view.setVerticalScrollMode(QAbstractItemView.ScrollMode.ScrollPerPixel)
+        self.message_view.setFocusPolicy(Qt.FocusPolicy.NoFocus)
+        self.message_view.setStyleSheet("QListView { border: none; background: transparent; }")
+        self.message_view.clicked.connect(self.on_message_clicked)
+        self.message_view.verticalScrollBar().valueChanged.connect(self.on_message_scroll)
+        self.scroll_timer = QTimer(self)
+        self.scroll_timer.setSingleShot(True)
+        self.scroll_timer.timeout.connect(self.message_view.scrollToBottom)
 
         input_row = QHBoxLayout()
 
@@ -446,8 +1307,19 @@ class AgenticChatApp(QMainWindow):
         input_row.addWidget(self.input_field)
         input_row.addWidget(self.send_btn)
 
+        self.transfers_panel = QWidget()
+        self.transfers_layout = QVBoxLayout(self.transfers_panel)
+        self.transfers_layout.setContentsMargins(0, 0, 0, 0)
+        self.transfers_layout.setSpacing(2)
+        self.transfers_summary = QLabel("")
+        self.transfers_summary.setFont(QFont('Arial', 9))
+        self.transfers_summary.setStyleSheet('color: #666;')
+        self.transfers_layout.addWidget(self.transfers_summary)
+        self.transfers_panel.hide()
+
         right_layout.addWidget(self.chat_header)
-        right_layout.addWidget(self.conversation_area)
+        right_layout.addWidget(self.message_view)
+        right_layout.addWidget(self.transfers_panel)
         right_layout.addLayout(input_row)
 
         layout.addWidget(left)
@@ -455,79 +1327,88 @@ class AgenticChatApp(QMainWindow):
 
         return page
         
-    def on_add_chat_list_item(self, name, icon):
-        it = QListWidgetItem(name)
-        it.setIcon(icon)
-        self.chat_list.addItem(it)
-
     def on_attach_clicked(self):
         current_friend = self.get_current_chat()
         if not current_friend:
             QMessageBox.warning(self, "No Chat Selected", "Please select a chat before sending a file.")
             return
 
-        path, _ = QFileDialog.getOpenFileName(self, "Select File to Send", "")
-        if not path:
-            return
-
-        upload_thread = threading.Thread(target=self.upload_file, args=(path, current_friend), daemon=True)
-        upload_thread.start()
+        paths, _ = QFileDialog.getOpenFileNames(self, "Select Files to Send", "")
+        for path in paths:
+            self.upload_file(path, current_friend)
+
+    def on_transfer_queued(self, transfer_id: str, label: str):
+        row = TransferRow(transfer_id, label)
+        row.cancel_requested.connect(self.transfers.cancel)
+        row.set_state("Queued")
+        self.transfer_rows[transfer_id] = row
+        self.transfer_states[transfer_id] = "Queued"
+        self.transfers_layout.addWidget(row)
+        self.update_transfers_summary()
+
+    def on_transfer_state(self, transfer_id: str, state: str):
+        row = self.transfer_rows.get(transfer_id)
+        if row:
+            row.set_state(state)
+        self.transfer_states[transfer_id] = "Active"
+        self.update_transfers_summary()
+
+    def on_transfer_progress(self, transfer_id: str, percent: int):
+        row = self.transfer_rows.get(transfer_id)
+        if row:
+            row.set_progress(percent)
+
+    def on_transfer_finished(self, transfer_id: str, status: str):
+        self.transfer_states[transfer_id] = status
+        row = self.transfer_rows.pop(transfer_id, None)
+        if row:
+            row.set_finished(status)
+            self.finished_transfer_rows.append((transfer_id, row))
+        while len(self.finished_transfer_rows) > TRANSFER_HISTORY_LIMIT:
+            old_id, old_row = self.finished_transfer_rows.pop(0)
+            self.transfer_states.pop(old_id, None)
+            old_row.deleteLater()
+        self.update_transfers_summary()
+
+    def update_transfers_summary(self):
+        states = list(self.transfer_states.values())
+        active = states.count("Active")
+        queued = states.count("Queued")
+        finished = len(states) - active - queued
+        self.transfers_summary.setText(f"Transfers: {active} active · {queued} queued · {finished} finished")
+        self.transfers_panel.setVisible(bool(states))
 
     def upload_file(self, file_path: str, recipient: str):
-        try:
-            url = f"http://{HOST}:{HTTP_PORT}/"
-            filename = os.path.basename(file_path)
-            mime_type, _ = mimetypes.guess_type(file_path)
-            if mime_type is None:
-                mime_type = 'application/octet-stream'
-
-            with open(file_path, 'rb') as f:
-                file_data = f.read()             
-                headers = {
-                    'X-Filename': filename,
-                    'Content-Type': mime_type,
-                }
-                # Visual indicator only, don't put in chat history yet
-                self.ai_indicator_signal.emit("Uploading...", True)
-            
-                response = requests.post(url, data=file_data, headers=headers, timeout=300)
-            
-            self.ai_indicator_signal.emit("Uploading...", False)
-            response.raise_for_status()
-            data = response.json()
-
-            if data.get("success"):
-                file_id = data.get("file_id")
-                file_name = data.get("filename")
-                file_url = data.get("url")
-
-                file_msg_payload = f"FILE|{file_id}|{file_name}|{file_url}"
-                payload = f"PRIVATE|{recipient}|{file_msg_payload}"
-                self.send_raw(payload)
+        def on_done(data):
+            file_id = data.get("file_id")
+            file_name = data.get("filename")
+            file_url = data.get("url")
 
-                self.append_global_message(self.nickname, recipient, file_msg_payload)
-                
-                # NOW we update the UI
-                timestamp = datetime.now().strftime('%H:%M')
-                self.ui_message_signal.emit(file_msg_payload, False, timestamp)
-                print(f"Successfully uploaded and sent file: {file_name}")
+            file_msg_payload = f"FILE|{file_id}|{file_name}|{file_url}"
+            msg_id = self.send_chat_message(recipient, file_msg_payload)
 
-            else:
-                raise Exception(data.get("error", "Unknown upload error"))
+            self.append_global_message(self.nickname, recipient, file_msg_payload, msg_id)
+            
+            # NOW we update the UI
+            timestamp = datetime.now().strftime('%H:%M')
+            self.conversation_message_signal.emit(recipient, file_msg_payload, False, timestamp)
+            print(f"Successfully uploaded and sent file: {file_name}")
 
-        except Exception as e:
-            self.ai_indicator_signal.emit("Uploading...", False)
+        def on_error(e):
+            if isinstance(e, TransferCancelled):
+                print(f"Upload cancelled: {file_path}")
+                return
             print(f"File upload failed: {e}")
             self.ui_message_signal.emit(f"(Upload Failed: {str(e)})", False, datetime.now().strftime('%H:%M'))
 
-    def on_file_bubble_clicked(self):
-        sender_button = self.sender()
-        if not sender_button:
-            return
+        self.transfers.submit_upload(file_path, self.http_token, on_done=on_done, on_error=on_error)
 
-        file_url = sender_button.property("file_url")
-        file_name = sender_button.property("file_name")
+    def on_message_clicked(self, index):
+        row = self.message_model.row_at(index)
+        if row["file"]:
+            self.download_file(*row["file"])
 
+    def download_file(self, file_id: str, file_name: str, file_url: str):
         if not file_url:
             return
 
@@ -535,21 +1416,69 @@ class AgenticChatApp(QMainWindow):
         if not save_path:
             return
 
-        try:
-            response = requests.get(file_url, stream=True)
-            response.raise_for_status()
+        def on_done(cached_path):
+            try:
+                shutil.copyfile(cached_path, save_path)
+                self.download_finished_signal.emit(file_name, save_path, "")
+            except Exception as e:
+                self.download_finished_signal.emit(file_name, save_path, str(e))
 
-            with open(save_path, 'wb') as f:
-                for chunk in response.iter_content(chunk_size=8192):
-                    f.write(chunk)
+        def on_error(e):
+            if not isinstance(e, TransferCancelled):
+                self.download_finished_signal.emit(file_name, save_path, str(e))
 
-            QMessageBox.information(self, "Download Complete", 
-                f"File '{file_name}' saved to:\n{save_path}")
-            webbrowser.open(f"file:///{os.path.dirname(save_path)}")
+        self.transfers.submit_download(file_url, file_id, file_name, on_done=on_done, on_error=on_error)
 
-        except Exception as e:
-            print(f"Download failed: {e}")
-            QMessageBox.critical(self, "Download Failed", f"Could not download file: {e}")
+    def on_download_finished(self, file_name: str, save_path: str, error: str):
+        if error:
+            print(f"Download failed: {error}")
+            QMessageBox.critical(self, "Download Failed", f"Could not download file: {error}")
+            return
+        QMessageBox.information(self, "Download Complete", 
+            f"File '{file_name}' saved to:\n{save_path}")
+        import webbrowser
+        webbrowser.open(f"file:///{os.path.dirname(save_path)}")
+
+    def request_thumbnail(self, file_id: str, file_url: str):
+        """Fetches the server thumbnail in the background unless it is cached, on its way or recently failed."""
+        if file_id in self.thumbnails or file_id in self.thumbnail_waiters:
+            return
+        failed_at = self.thumbnail_failures.get(file_id)
+        if failed_at is not None and time.monotonic() - failed_at < THUMBNAIL_RETRY_SECONDS:
+            return  # repaints must not turn a 404 into a request per frame
+        self.thumbnail_waiters.add(file_id)
+
+        def fetch():
+            try:
+                path, _ = cached_download(thumbnail_url_for(file_url), f"thumb_{file_id}", timeout=15,
+                                          session=self.transfers.session)
+                if path:
+                    with open(path, 'rb') as f:
+                        self.thumbnail_ready_signal.emit(file_id, f.read())
+                    return
+            except Exception as e:
+                print(f"Thumbnail fetch failed: {e}")
+            self.thumbnail_ready_signal.emit(file_id, b"")
+
+        threading.Thread(target=fetch, daemon=True).start()
+
+    def on_thumbnail_ready(self, file_id: str, data: bytes):
+        self.thumbnail_waiters.discard(file_id)
+        pix = QPixmap()
+        if not data or not pix.loadFromData(data):
+            self.thumbnail_failures[file_id] = time.monotonic()
+            return  # no preview; bubbles keep their plain file label
+        self.thumbnail_failures.pop(file_id, None)
+        self.thumbnails[file_id] = pix.scaled(THUMBNAIL_DISPLAY_SIZE, THUMBNAIL_DISPLAY_SIZE,
+                                              Qt.AspectRatioMode.KeepAspectRatio,
+                                              Qt.TransformationMode.SmoothTransformation)
+        bar = self.message_view.verticalScrollBar()
+        at_bottom = bar.value() >= bar.maximum()
+        delegate = self.message_view.itemDelegate()
+        for index in self.message_model.rows_for_file(file_id):
+            delegate.sizeHintChanged.emit(index)
+        if at_bottom:
+            self.schedule_scroll_to_bottom()  # the taller bubble must not push the chat up
 
     def trigger_clear_chat(self, friend: str):
         reply = QMessageBox.warning(
@@ -563,9 +1492,9 @@ class AgenticChatApp(QMainWindow):
         if reply == QMessageBox.StandardButton.Yes:
             self.send_raw(f"/clear {friend}")
             self.clear_local_chat(friend)
-            current_chat_friend = self.get_current_chat()
-            if current_chat_friend == friend:
-                self.chat_layout_parent_clear()
+            if self.open_conversation == friend:
+                self.message_model.clear()
+                self.history_offset = 0
 
             QMessageBox.information(self, "Chat Cleared", f"Chat with {friend} has been cleared.")
 
@@ -720,69 +1649,154 @@ class AgenticChatApp(QMainWindow):
         self.login_username = self.nickname
         self.login_password = password.strip()
         # ---------------------------------------------------------
+        self.startup.last = time.perf_counter()  # time spent typing is not startup cost
 
         self.user_profile_dir = os.path.join(PROFILES_DIR, self.nickname)
         self.user_profile_file = os.path.join(self.user_profile_dir, "profile.json")
         os.makedirs(self.user_profile_dir, exist_ok=True)
-        
-        self.load_profile_info()
-        self.load_own_profile_pic()
 
-        with GLOBAL_CHAT_LOCK:
-            hist = load_global_chat_history()
-            self.global_history = hist if hist is not None else {}
-            
-        self.global_history.setdefault(self.nickname, {})
-        self.load_all_profile_pics()
-        self.refresh_chat_list_from_history()
+        # history, chat list and profile are loaded by finish_startup once the window is up
+        self.store = LocalMessageStore(LOCAL_STORE_FILE)
 
         try:
-            raw_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
-            cert_path = os.path.join(os.getcwd(), "server.crt")
-            if os.path.exists(cert_path):
-                context.load_verify_locations(cert_path)
-                context.verify_mode = ssl.CERT_REQUIRED
-                context.check_hostname = False
-            else:
-                context.check_hostname = False
-                context.verify_mode = ssl.CERT_NONE
-
-            self.sock = context.wrap_socket(raw_sock, server_hostname=HOST)
-            self.sock.connect((HOST, PORT))
+            self.sock = self.open_connection()
 
             # ---------------- NEW: SEND LOGIN MESSAGE ----------------
             try:
                 login_packet = f"LOGIN|{self.login_username}|{self.login_password}"
-                self.sock.send(login_packet.encode())
+                self.sock.sendall(encode_frame(f"CAPS|{CLIENT_CAPS}") + encode_frame(login_packet))
             except Exception as e:
                 QMessageBox.critical(self, "Login Error", f"Failed to send login request: {e}")
                 return
             # ----------------------------------------------------------
 
         except Exception as e:
+            self.sock = None
+            self.startup.mark("connect (failed)")
             QMessageBox.critical(self, "Connection Error", f"Failed to connect to server: {e}")
             return
+        self.startup.mark("connect + login sent")
+        # friends and pending requests arrive as a snapshot event after login, then as deltas
+    def open_connection(self):
+        raw_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        cert_path = os.path.join(os.getcwd(), "server.crt")
+        if os.path.exists(cert_path):
+            context.load_verify_locations(cert_path)
+            context.verify_mode = ssl.CERT_REQUIRED
+            context.check_hostname = False
+        else:
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
 
+        sock = context.wrap_socket(raw_sock, server_hostname=HOST)
+        sock.connect((HOST, PORT))
+        return sock
+
+    def start_receiver(self):
         self.receiver = ReceiverThread(self.sock)
-        self.receiver.message_received.connect(self.handle_incoming)
+        self.receiver.messages_ready.connect(self.on_messages_ready)
         self.receiver.connection_error.connect(self.on_connection_error)
         self.receiver.start()
 
-        self.friends_timer.start(FRIENDS_REFRESH_INTERVAL_MS)
-        self.pending_timer.start(PENDING_REFRESH_INTERVAL_MS)
-
-        QTimer.singleShot(700, self.request_friends_list)
-        QTimer.singleShot(900, self.request_pending_list)
     def on_connection_error(self, text):
-        QMessageBox.critical(self, "Connection Error", text)
+        """The link dropped: keep the window usable and reconnect in the background."""
+        print(f"Connection lost: {text}")
+        self.sock = None
+        self.session_ready = False
+        self.schedule_reconnect()
+
+    def schedule_reconnect(self):
+        if self.reconnecting:
+            return
+        self.reconnecting = True
+        delay = min(RECONNECT_MAX_DELAY, RECONNECT_BASE_DELAY * 2 ** self.reconnect_attempts)
+        self.reconnect_attempts += 1
+        self.setWindowTitle(f"Connect (offline, retrying in {delay}s)")
+        QTimer.singleShot(delay * 1000, self.reconnect)
+
+    def reconnect(self):
+        """Opens a new connection off the UI thread and resumes the session, or logs in again."""
+        hello = encode_frame(f"CAPS|{CLIENT_CAPS}")
+        if self.resume_token:
+            hello += encode_frame(f"RESUME|{self.resume_token}")
+        else:
+            hello += encode_frame(f"LOGIN|{self.login_username}|{self.login_password}")
+
+        def run():
+            try:
+                sock = self.open_connection()
+                sock.sendall(hello)
+            except Exception as e:
+                print(f"Reconnect failed: {e}")
+                sock = None
+            self.reconnected_signal.emit(sock)
+
+        self.setWindowTitle("Connect (reconnecting…)")
+        threading.Thread(target=run, daemon=True).start()
+
+    def on_reconnected(self, sock):
+        self.reconnecting = False
+        if sock is None:
+            self.schedule_reconnect()
+            return
+        self.sock = sock
+        self.start_receiver()  # RESUME_OK / LOGIN_OK resets the backoff
+
+    def on_session_ready(self, payload: str):
+        """LOGIN_OK or RESUME_OK; newer servers append the negotiated caps and a resume token."""
+        self.reconnect_attempts = 0
+        self.setWindowTitle("Connect")
+        if payload:
+            try:
+                info = json.loads(payload)
+                self.server_caps = set(info.get("caps", []))
+                self.resume_token = info.get("resume")
+                self.http_token = info.get("http_token")
+            except ValueError:
+                pass
+        # whatever the server has not acknowledged may have died with the old socket
+        queued = set(self.write_queue)
+        self.write_queue[:0] = [frame for frame in self.outbox.values() if frame not in queued]
+        self.session_ready = True
+        self.write_timer.start(0)
+
+    def send_acks(self):
+        """Tells the server which messages are stored (and which were read in the open chat)."""
+        acks, self.pending_acks = self.pending_acks, {}
+        reads, self.pending_reads = self.pending_reads, {}
+        for friend, msg_id in reads.items():
+            self.send_raw(f"/clearunread {friend} {msg_id}")
+        if "resume" not in self.server_caps:
+            return
+        for sender, msg_id in acks.items():
+            self.send_raw(f"ACK|{sender}|{msg_id}")
 
     def send_raw(self, text: str):
+        """Queues a frame for the next write; safe to call from worker threads."""
+        self.outgoing_frame_signal.emit(text, "")
+
+    def send_chat_message(self, recipient: str, text: str) -> str:
+        """Sends through the outbox, which retransmits after a reconnect until the server acks it."""
+        msg_id = uuid.uuid4().hex
+        self.outgoing_frame_signal.emit(f"PRIVATE_ID|{msg_id}|{recipient}|{text}", msg_id)
+        return msg_id
+
+    def enqueue_frame(self, frame: str, msg_id: str):
+        if msg_id and "ack" in self.server_caps:
+            self.outbox[msg_id] = frame
+        self.write_queue.append(frame)
+        if not self.write_timer.isActive():
+            self.write_timer.start(0)  # everything queued in this event-loop turn goes out in one write
+
+    def flush_writes(self):
+        if not self.write_queue or not self.sock or not self.session_ready:
+            return  # kept queued; on_session_ready flushes after the next login
+        frames, self.write_queue = self.write_queue, []
         try:
-            if self.sock:
-                self.sock.send(text.encode('utf-8'))
+            self.sock.sendall(b"".join(encode_frame(f) for f in frames))
         except Exception as e:
-            print("Send failed:", e)
+            print("Send failed:", e)  # chat messages stay in the outbox for the reconnect
 
     def request_friends_list(self):
         try:
@@ -827,12 +1841,88 @@ class AgenticChatApp(QMainWindow):
             return 'FileMania'
         return None
 
+    def handle_ai_result(self, result: dict):
+        source = result.get("source")
+        if result.get("status") != "running":
+            self.clear_ai_running(source)
+        self.ai_display.append(result.get("text", ""))
+
+    def handle_event(self, event: dict):
+        """Applies a server-pushed EVENT frame; only the affected rows change."""
+        kind = event.get("type")
+        name = event.get("name")
+        if kind == "snapshot":
+            self.apply_friends_data(friends_data_from_records(event.get("friends", [])))
+            self.pending_entries = list(event.get("pending", []))
+            self.pending_list_data_signal.emit([{"name": n} for n in self.pending_entries])
+            for peer, count in event.get("unread", {}).items():
+                if peer != self.open_conversation:
+                    self.unread_local[peer] = count
+                    self.mark_unread(peer)
+        elif kind == "presence":
+            online = bool(event.get("online"))
+            self.friend_online[name] = online
+            if self.chat_model.row_of(name) >= 0:
+                self.chat_model.update(name, online=online)
+            for entry in self.friends_data:
+                if entry["name"] == name:
+                    entry["online"] = online
+            for i in range(self.friends_list_widget.count()):
+                item = self.friends_list_widget.item(i)
+                if item.text() == name:
+                    item.setData(Qt.ItemDataRole.UserRole, {**(item.data(Qt.ItemDataRole.UserRole) or {}), 'online': online})
+            self.refresh_friend_icons({name})
+        elif kind == "friend_added":
+            if all(entry["name"] != name for entry in self.friends_data):
+                self.apply_friends_data(self.friends_data + [
+                    {"name": name, "online": bool(event.get("online")), "has_unread": False}])
+        elif kind == "request_received":
+            if name not in self.pending_entries:
+                self.pending_entries.append(name)
+                self.pending_list_data_signal.emit([{"name": n} for n in self.pending_entries])
+        elif kind == "unread":
+            # the server's counter is authoritative; it already includes the message that triggered it
+            if name != self.open_conversation:
+                self.unread_local[name] = event.get("count", 0)
+                self.mark_unread(name)
+
+    def on_messages_ready(self):
+        """Handles everything the receiver has queued; stored messages share one transaction."""
+        frames = self.receiver.take_pending()
+        with self.store.batch():
+            for raw in frames:
+                try:
+                    self.handle_incoming(raw)
+                except Exception:
+                    traceback.print_exc()
+        self.send_acks()  # after the commit: acked messages are on disk
+
     def handle_incoming(self, raw: str):
         raw = raw.strip()
 
         # ----------------- LOGIN RESPONSES -----------------
-        if raw.startswith("LOGIN_OK"):
-            # Login succeeded, proceed normally
+        if raw.startswith("LOGIN_OK") or raw.startswith("RESUME_OK"):
+            self.on_session_ready(raw.partition("|")[2])
+            return
+
+        if raw.startswith("RESUME_FAIL"):
+            # token unknown (e.g. the server restarted): log in with the saved credentials instead
+            self.resume_token = None
+            try:
+                self.sock.sendall(encode_frame(f"LOGIN|{self.login_username}|{self.login_password}"))
+            except Exception as e:
+                print("Login failed:", e)
+            return
+
+        if raw.startswith("SENT|"):
+            self.outbox.pop(raw[len("SENT|"):], None)
+            return
+
+        if raw.startswith("REJECTED|"):
+            # final: the server will never store it, so stop retransmitting
+            _, msg_id, reason = (raw.split("|", 2) + [""])[:3]
+            self.outbox.pop(msg_id, None)
+            self.ui_message_signal.emit(f"(Not delivered: {reason})", True, datetime.now().strftime('%H:%M'))
             return
 
         if raw.startswith("LOGIN_FAIL"):
@@ -847,11 +1937,51 @@ class AgenticChatApp(QMainWindow):
 
         if raw == "NICK":
             try:
-                self.sock.send(self.nickname.encode('utf-8'))
+                self.sock.sendall(encode_frame(self.nickname))
             except Exception:
                 pass
             return
 
+        if raw.startswith("EVENT|"):
+            try:
+                self.handle_event(json.loads(raw[len("EVENT|"):]))
+            except ValueError:
+                print(f"Malformed event: {raw[:80]}")
+            return
+
+        # Structured replies (json capability): decoded in one pass, no text scraping
+        if raw.startswith("FRIENDS|"):
+            self.awaiting_friends = False
+            try:
+                self.apply_friends_data(friends_data_from_records(json.loads(raw[len("FRIENDS|"):])))
+            except ValueError:
+                print(f"Malformed friends reply: {raw[:80]}")
+            return
+
+        if raw.startswith("PENDING|"):
+            self.awaiting_pending = False
+            try:
+                self.pending_entries = list(json.loads(raw[len("PENDING|"):]))
+            except ValueError:
+                print(f"Malformed pending reply: {raw[:80]}")
+                return
+            self.pending_list_data_signal.emit([{"name": n} for n in self.pending_entries])
+            return
+
+        if raw.startswith("AI|"):
+            try:
+                self.handle_ai_result(json.loads(raw[len("AI|"):]))
+            except ValueError:
+                print(f"Malformed AI reply: {raw[:80]}")
+            return
+
+        if raw.startswith("SEARCH|"):
+            try:
+                self.show_search_results(json.loads(raw[len("SEARCH|"):]))
+            except ValueError:
+                print(f"Malformed search reply: {raw[:80]}")
+            return
+
         if self.awaiting_friends and raw.startswith("Your friends:"):
             self.awaiting_friends = False
             self.prepare_friends_data(raw)
@@ -863,18 +1993,23 @@ class AgenticChatApp(QMainWindow):
             return
 
         if "|" in raw:
-            sender, msg = raw.split("|", 1)
+            if raw.startswith("MSG|") and raw.count("|") >= 3:
+                _, msg_id, sender, msg = raw.split("|", 3)
+                self.pending_acks[sender] = msg_id
+            else:
+                sender, msg = raw.split("|", 1)
+                msg_id = uuid.uuid4().hex
             
-            # 1. Persist to disk (Thread-Safe & Deduped & Defensively Merged)
-            self.append_global_message(sender, self.nickname, msg)
+            # 1. Persist; a message we already hold (e.g. written by a local client of the sender) is dropped
+            if not self.append_global_message(sender, self.nickname, msg, msg_id):
+                return
             
-            current = self.get_current_chat()
-            if current and current == sender:
-                timestamp = datetime.now().strftime('%H:%M')
-                self.ui_message_signal.emit(msg, True, timestamp)
-            else:
-                self.unread_local.setdefault(sender, []).append(msg)
+            self.on_conversation_message(sender, msg, True, datetime.now().strftime('%H:%M'))
+            if self.open_conversation != sender:
+                self.unread_local[sender] = self.unread_local.get(sender, 0) + 1
                 self.mark_unread(sender)
+            else:
+                self.pending_reads[sender] = msg_id  # read on arrival; the server counted it as unread
             return
 
         ai_name = self.detect_ai_name_from_text(raw)
@@ -899,7 +2034,7 @@ class AgenticChatApp(QMainWindow):
 
         try:
             msg = f"CHANGE_PASS|{self.login_username}|{self.login_password}|{new_pass.strip()}"
-            self.sock.send(msg.encode())
+            self.sock.sendall(encode_frame(msg))
             QMessageBox.information(self, "Success", "Password updated. Restart app to login again.")
             sys.exit(0)
 
@@ -923,66 +2058,73 @@ class AgenticChatApp(QMainWindow):
             online = '🔥' in symbols
             has_unread = '🗣️' in symbols or '🗣' in symbols
             
-            # Pre-loading pixmap here is technically IO but usually fast enough
-            # If very slow, move to separate thread, but here it is safe to read
-            # effectively decoupling UI update from data parsing
-            dp = self.load_profile_pixmap(name)
-            
             friends_data.append({
                 "name": name,
                 "online": online,
-                "has_unread": has_unread,
-                "pixmap": dp
+                "has_unread": has_unread
             })
             
+        self.apply_friends_data(friends_data)
+
+    def apply_friends_data(self, friends_data: list):
+        self.friends_data = friends_data
         self.friends_list_data_signal.emit(friends_data)
 
+        unsynced = [d["name"] for d in friends_data if d["name"] not in self.avatars_synced]
+        if unsynced:
+            self.avatars_synced.update(unsynced)
+            self.sync_profile_pics(unsynced)
+
+    def sync_profile_pics(self, names):
+        """Revalidates friends' avatars against the file server in the background."""
+        def run():
+            for name in names:
+                try:
+                    url = f"http://{HOST}:{HTTP_PORT}/avatars/{name}"
+                    path, modified = cached_download(url, f"avatar_{name}", timeout=10,
+                                                     session=self.transfers.session)
+                except Exception as e:
+                    print(f"Avatar sync failed for {name}: {e}")
+                    continue
+                if path and modified:
+                    shutil.copyfile(path, os.path.join(PROFILES_DIR, f"{name}.png"))
+                    self.avatar_changed_signal.emit(name)
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def push_profile_picture(self, path: str):
+        try:
+            with open(path, 'rb') as f:
+                response = self.transfers.session.post(f"http://{HOST}:{HTTP_PORT}/avatars/{self.nickname}",
+                                         data=f.read(), timeout=30,
+                                         headers={'Content-Type': 'image/png', 'X-Session-Token': self.http_token or ''})
+            response.raise_for_status()
+        except Exception as e:
+            print(f"Profile picture upload failed: {e}")
+
     def on_update_friends_ui(self, data_list: list):
         """Slot to update Friends and Chat list widgets safely on Main Thread."""
         self.friends_list_widget.clear()
-        
-        # Map existing items in chat list to preserve them
-        existing_chat_items = {
-            self.chat_list.item(i).text().split(' (')[0]: self.chat_list.item(i) 
-            for i in range(self.chat_list.count())
-        }
 
         for item_data in data_list:
             name = item_data["name"]
             online = item_data["online"]
             has_unread = item_data["has_unread"]
-            pixmap = item_data["pixmap"]
+            self.friend_online[name] = online
 
             # 1. Update Friends List Widget
             f_item = QListWidgetItem(name)
-            if pixmap:
-                f_item.setIcon(avatar_icon_for(name, pixmap, size=32, online=online))
-            else:
-                f_item.setIcon(self.make_status_icon(online))
+            f_item.setIcon(self.avatar_icon(name, 32, online))
             f_item.setData(Qt.ItemDataRole.UserRole, {'online': online, 'unread': has_unread})
             self.friends_list_widget.addItem(f_item)
 
-            # 2. Update Chat List Widget
-            # Create icons
-            if pixmap:
-                icon_small = avatar_icon_for(name, pixmap, size=28, online=online)
-            else:
-                icon_small = self.make_status_icon(online)
+            # 2. Update the chat row (added at the bottom if there is no history yet)
+            self.chat_model.update(name, online=online)
 
-            if name not in existing_chat_items:
-                chat_item = QListWidgetItem(name)
-                chat_item.setIcon(icon_small)
-                self.chat_list.addItem(chat_item)
-            else:
-                existing_item = existing_chat_items[name]
-                existing_item.setIcon(icon_small)
-                
             # 3. Handle Unread
             if has_unread and not self.unread_local.get(name):
-                self.unread_local.setdefault(name, ["(server) unread placeholder"]) 
+                self.unread_local[name] = 1  # text replies only say "some"; exact counts come with the snapshot
                 self.mark_unread(name)
-        
-        self.refresh_chat_list_badges()
 
     def prepare_pending_data(self, raw_text: str):
         lines = raw_text.splitlines()
@@ -1001,19 +2143,15 @@ class AgenticChatApp(QMainWindow):
         self.pending_entries = pending_lines
         
         # Prepare data for UI
-        ui_data = []
-        for name in pending_lines:
-             dp = self.load_profile_pixmap(name)
-             ui_data.append({"name": name, "pixmap": dp})
-             
+        ui_data = [{"name": name} for name in pending_lines]
         self.pending_list_data_signal.emit(ui_data)
 
     def on_update_pending_ui(self, data_list: list):
         self.pending_list_widget.clear()
+        self.pending_avatar_labels = {}
         
         for idx, item_data in enumerate(data_list):
             name = item_data["name"]
-            pixmap = item_data["pixmap"]
             
             row = QWidget()
             h = QHBoxLayout(row)
@@ -1021,12 +2159,8 @@ class AgenticChatApp(QMainWindow):
             h.setSpacing(8)
             
             avatar = QLabel()
-            if pixmap:
-                avatar.setPixmap(circular_pixmap(pixmap, 36))
-            else:
-                tmp = QPixmap(36,36)
-                tmp.fill(Qt.GlobalColor.transparent)
-                avatar.setPixmap(tmp)
+            avatar.setPixmap(self.avatar_pixmap(name, 36))
+            self.pending_avatar_labels[name] = avatar
             avatar.setFixedSize(36, 36)
             avatar.setStyleSheet("border-radius:18px; background-color:#ddd;")
             h.addWidget(avatar)
@@ -1059,325 +2193,257 @@ class AgenticChatApp(QMainWindow):
             self.pending_list_widget.setItemWidget(item, row)
 
     def make_status_icon(self, online: bool, size=14):
-        pix = QPixmap(size, size)
-        pix.fill(Qt.GlobalColor.transparent)
-        p = QPainter(pix)
-        p.setRenderHint(QPainter.RenderHint.Antialiasing)
-        color = QColor("#28a745") if online else QColor("#666666")
-        p.setBrush(color)
-        p.setPen(Qt.GlobalColor.transparent)
-        p.drawEllipse(0, 0, size, size)
-        p.end()
-        return QIcon(pix)
+        def render():
+            pix = QPixmap(size, size)
+            pix.fill(Qt.GlobalColor.transparent)
+            p = QPainter(pix)
+            p.setRenderHint(QPainter.RenderHint.Antialiasing)
+            color = QColor("#28a745") if online else QColor("#666666")
+            p.setBrush(color)
+            p.setPen(Qt.GlobalColor.transparent)
+            p.drawEllipse(0, 0, size, size)
+            p.end()
+            return QIcon(pix)
+        return self.avatar_cache.get((None, size, online, "status"), render)
+
+    def avatar_icon(self, nickname: str, size: int, online: bool) -> QIcon:
+        """Circular avatar with online dot, or the plain status dot when there is no picture."""
+        pixmap = self.load_profile_pixmap(nickname)
+        if pixmap is None:
+            return self.make_status_icon(online)
+        key = (nickname, size, online, self.avatar_mtimes.get(nickname))
+        return self.avatar_cache.get(key, lambda: avatar_icon_for(nickname, pixmap, size=size, online=online))
+
+    def avatar_pixmap(self, nickname: str, size: int) -> QPixmap:
+        """Circular avatar pixmap; transparent when there is no picture."""
+        pixmap = self.load_profile_pixmap(nickname) or QPixmap()
+        key = (nickname, size, "pixmap", self.avatar_mtimes.get(nickname))
+        return self.avatar_cache.get(key, lambda: circular_pixmap(pixmap, size))
+
+    def forget_avatar(self, nickname: str):
+        """Drops a replaced picture so the next lookup reads it from disk again."""
+        self.profile_pics.pop(nickname, None)
+        self.avatar_mtimes.pop(nickname, None)
+        self.missing_avatars.discard(nickname)
+
+    def on_avatar_changed(self, nickname: str):
+        self.forget_avatar(nickname)
+        self.load_profile_pixmap(nickname)
+
+    def decode_avatar_job(self, nickname: str):
+        try:
+            image, mtime = decode_avatar(nickname)
+        except Exception as e:
+            print(f"Avatar decode failed for {nickname}: {e}")
+            image, mtime = None, None
+        self.avatar_decoded_signal.emit(nickname, image, mtime)
+
+    def on_avatar_decoded(self, nickname: str, image, mtime):
+        self.avatar_loading.discard(nickname)
+        if image is None:
+            self.missing_avatars.add(nickname)
+            return  # the placeholder already on screen stays
+        self.profile_pics[nickname] = QPixmap.fromImage(image)
+        self.avatar_mtimes[nickname] = mtime
+        self.avatar_refresh.add(nickname)
+        if not self.avatar_refresh_timer.isActive():
+            self.avatar_refresh_timer.start(UI_FRAME_MS)
+
+    def refresh_avatar_icons(self):
+        """Swaps placeholders for pictures that finished decoding, once per UI frame."""
+        names, self.avatar_refresh = self.avatar_refresh, set()
+        self.refresh_friend_icons(names)
+
+    def refresh_friend_icons(self, names: set):
+        for i in range(self.friends_list_widget.count()):
+            item = self.friends_list_widget.item(i)
+            if item.text() in names:
+                item.setIcon(self.avatar_icon(item.text(), 32, self.friend_online.get(item.text(), False)))
+        self.chat_model.refresh(names)
+        for name in names & self.pending_avatar_labels.keys():
+            try:
+                self.pending_avatar_labels[name].setPixmap(self.avatar_pixmap(name, 36))
+            except RuntimeError:
+                pass  # pending list was rebuilt
+        if self.open_conversation in names:
+            self.header_avatar.setPixmap(self.avatar_pixmap(self.open_conversation, 48))
 
     def on_friends_tab_clicked(self):
         self.stacked_widget.setCurrentWidget(self.friend_page)
-        self.request_friends_list()
-        QTimer.singleShot(200, self.request_pending_list)
+        # lists are kept current by server events; only revalidate the avatars
+        self.avatars_synced.clear()
+        self.apply_friends_data(self.friends_data)
 
     def add_message_to_view(self, text, incoming=True, timestamp=None):
-        if not timestamp:
-            timestamp = datetime.now().strftime('%H:%M')
-        else:
-            if isinstance(timestamp, str) and ':' in timestamp and len(timestamp) <= 5:
-                timestamp_str = timestamp 
-            else:
-                try:
-                    ts = datetime.fromisoformat(timestamp)
-                    timestamp_str = ts.strftime('%H:%M')
-                except Exception:
-                    timestamp_str = datetime.now().strftime('%H:%M')
-        is_file_message = False
-        if text.startswith("FILE|"):
-            try:
-                _, file_id, file_name, file_url = text.split("|", 3)
-                is_file_message = True
-            except Exception:
-                pass
-
-        if is_file_message:
-            bubble = QPushButton(f"📄 {file_name}") 
-            bubble.setCursor(Qt.CursorShape.PointingHandCursor)
-            bubble.setToolTip(f"Click to download '{file_name}'")
-            bubble.setProperty("file_url", file_url)
-            bubble.setProperty("file_name", file_name)
-            bubble.clicked.connect(self.on_file_bubble_clicked)
-            bubble.setStyleSheet(f"padding:10px; border-radius:12px; background-color:{COLOR_PANEL if incoming else COLOR_ACCENT}; color:{'black' if incoming else 'white'}; text-align: left;")
-
-        else:
-            bubble = QLabel(text)
-            bubble.setWordWrap(True)        
-            bubble.setStyleSheet(f"padding:10px; border-radius:12px; background-color:{COLOR_PANEL if incoming else COLOR_ACCENT}; color:{'black' if incoming else 'white'};")
-
-        bubble.setMaximumWidth(480)
-        ts_lbl = QLabel(timestamp_str) 
-        ts_lbl.setFont(QFont('Arial', 8))
-        ts_lbl.setStyleSheet('color: #666;')
-        ts_lbl.setAlignment(Qt.AlignmentFlag.AlignRight)
-        v = QVBoxLayout()
-        v.setContentsMargins(0,0,0,0)
-        v.addWidget(bubble)
-        v.addWidget(ts_lbl)
-        container_inner = QWidget()
-        container_inner.setLayout(v)
-        wrapper = QHBoxLayout()
-        wrapper.setContentsMargins(8,4,8,4)
-        if incoming:
-            wrapper.addWidget(container_inner)
-            wrapper.addStretch()
-        else:
-            wrapper.addStretch()
-            wrapper.addWidget(container_inner)
-        container = QWidget()
-        container.setLayout(wrapper)
-        self.chat_layout.addWidget(container)
-        QTimer.singleShot(50, lambda: self.conversation_area.verticalScrollBar().setValue(self.conversation_area.verticalScrollBar().maximum()))
-
-    def on_chat_selected(self, item: QListWidgetItem):
-        if not item: return
-        friend = item.text().split(' (')[0]
-        
-        # 1. Thread-safe load from disk to memory
-        with GLOBAL_CHAT_LOCK:
-            data = load_global_chat_history()
-            if data is not None:
-                self.global_history = data
-            # If data is None, we keep the existing self.global_history state (Defensive)
+        """Shows a row in the open chat only; conversation messages go through on_conversation_message."""
+        row = make_message_row(text, incoming, timestamp or datetime.now().strftime('%H:%M'))
+        self.message_model.append_message(row)
+        self.schedule_scroll_to_bottom()
+
+    def schedule_scroll_to_bottom(self):
+        """Coalesces scroll requests so a burst of rows scrolls the view once."""
+        if not self.scroll_timer.isActive():
+            self.scroll_timer.start(UI_FRAME_MS)
+
+    def conversation_rows(self, friend: str) -> list:
+        """Message rows for a chat; the first open reads only the newest page from the store."""
+        rows = self.conversations.get(friend)
+        if rows is None:
+            rows = self.conversations[friend] = self.page_rows(friend, self.load_local_chat(friend))
+        return rows
+
+    def fetch_older_rows(self, friend: str) -> int:
+        """Puts the page before the oldest loaded row in front of the cached rows; returns how many."""
+        before = self.oldest_seq.get(friend)
+        if before is None:
+            return 0  # everything is loaded
+        older = self.page_rows(friend, self.load_local_chat(friend, before))
+        self.conversations[friend][:0] = older
+        return len(older)
+
+    def page_rows(self, friend: str, page: list) -> list:
+        """Message rows of a store page; a short page means the start of the chat was reached."""
+        self.oldest_seq[friend] = page[0]["seq"] if len(page) == HISTORY_PAGE_SIZE else None
+        return [make_message_row(m['message'] or "", m['sender'] != self.nickname, m['timestamp']) for m in page]
+
+    def on_conversation_message(self, friend: str, text: str, incoming: bool, timestamp: str):
+        """Keeps the cached rows of a chat current and appends to the view if that chat is open."""
+        self.chat_model.touch(friend, datetime.now().timestamp())
+        rows = self.conversations.get(friend)
+        if rows is None:
+            return  # loaded from the store when the chat is first opened
+        row = make_message_row(text, incoming, timestamp)
+        rows.append(row)
+        if friend == self.open_conversation:
+            self.message_model.append_message(row)
+            self.schedule_scroll_to_bottom()
+
+    def on_message_scroll(self, value: int):
+        if value == 0 and self.message_view.verticalScrollBar().maximum() > 0 and \
+                (self.history_offset > 0 or self.oldest_seq.get(self.open_conversation) is not None):
+            self.load_older_messages()
+
+    def load_older_messages(self):
+        rows = self.conversations.get(self.open_conversation, [])
+        if self.history_offset == 0:
+            self.history_offset = self.fetch_older_rows(self.open_conversation)
+        start = max(0, self.history_offset - HISTORY_PAGE_SIZE)
+        older = rows[start:self.history_offset]
+        self.history_offset = start
+        self.message_model.prepend_messages(older)
+        # keep the row that was at the top where it was instead of jumping to the oldest message
+        self.message_view.scrollTo(self.message_model.index(len(older)), QAbstractItemView.ScrollHint.PositionAtTop)
+
+    def on_chat_selected(self, index):
+        friend = self.chat_model.name_at(index)
+        if not friend: return
             
         self.header_name.setText(friend)
-        avatar = self.profile_pics.get(friend)
-        if avatar:
-            self.header_avatar.setPixmap(circular_pixmap(avatar, 48))
-        else:
-            p = QPixmap(48,48)
-            p.fill(Qt.GlobalColor.transparent)
-            self.header_avatar.setPixmap(p)
+        self.header_avatar.setPixmap(self.avatar_pixmap(friend, 48))
         self.chat_header.show()
         
-        # 2. Clear view and repopulate from refreshed memory
-        self.chat_layout_parent_clear()
+        # Show the newest page; the store is read once per chat, one page at a time
+        rows = self.conversation_rows(friend)
+        self.open_conversation = friend
+        self.history_offset = max(0, len(rows) - HISTORY_PAGE_SIZE)
+        self.message_model.set_messages(rows[self.history_offset:])
+        self.message_view.scrollToBottom()
         
-        history = self.load_local_chat(friend)
-        
-        for m in history:
-            incoming = (m.get('sender') != self.nickname)
-            self.add_message_to_view(m.get('message'), incoming=incoming, timestamp=m.get('timestamp'))
-        
-        if friend in self.unread_local and self.unread_local[friend]:
-            self.unread_local[friend] = []
+        if self.unread_local.get(friend):
+            self.unread_local[friend] = 0
             self.send_raw(f"/clearunread {friend}")
-            self.refresh_chat_list_badges()
-
-    def chat_layout_parent_clear(self):
-        while self.chat_layout.count():
-            child = self.chat_layout.takeAt(0)
-            if child.widget():
-                child.widget().deleteLater()
+            self.chat_model.update(friend, unread=0)
 
     def on_send_clicked(self):
         text = self.input_field.text().strip()
         if not text:
             return
         current = self.get_current_chat()
-        if current:
-            payload = f"PRIVATE|{current}|{text}"
-            self.send_raw(payload)
-            self.append_global_message(self.nickname, current, text)
-            self.add_message_to_view(text, incoming=False, timestamp=datetime.now().strftime('%H:%M'))
+        if current and not text.startswith("/search "):
+            msg_id = self.send_chat_message(current, text)
+            self.append_global_message(self.nickname, current, text, msg_id)
+            self.on_conversation_message(current, text, False, datetime.now().strftime('%H:%M'))
             self.input_field.clear()
         else:
             self.send_raw(text)
             self.input_field.clear()
 
     def get_current_chat(self):
-        cur = self.chat_list.currentItem()
-        return cur.text().split(' (')[0] if cur else None
-
-    def load_all_profile_pics(self):
-        try:
-            for fname in os.listdir(PROFILES_DIR):
-                if not fname.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp')):
-                    continue
-                nick = os.path.splitext(fname)[0]
-                path = os.path.join(PROFILES_DIR, fname)
-                try:
-                    pix = QPixmap(path)
-                    if not pix.isNull():
-                        self.profile_pics[nick] = pix
-                except Exception:
-                    pass
-        except Exception:
-            pass
+        return self.chat_model.name_at(self.chat_list.currentIndex())
 
     def load_profile_pixmap(self, nickname):
+        """Returns the decoded picture, or None while it is missing or still decoding on avatar_pool."""
         if nickname in self.profile_pics:
             return self.profile_pics[nickname]
-        path_png = os.path.join(PROFILES_DIR, f"{nickname}.png")
-        path_jpg = os.path.join(PROFILES_DIR, f"{nickname}.jpg")
-        for p in (path_png, path_jpg):
-            if os.path.exists(p):
-                try:
-                    pix = QPixmap(p)
-                    if not pix.isNull():
-                        self.profile_pics[nickname] = pix
-                        return pix
-                except Exception:
-                    pass
+        if nickname in self.missing_avatars or nickname in self.avatar_loading:
+            return None
+        self.avatar_loading.add(nickname)
+        self.avatar_pool.submit(self.decode_avatar_job, nickname)
         return None
 
     def refresh_chat_list_from_history(self):
-        self.chat_list.clear()
-        user_hist = self.global_history.get(self.nickname, {})
-        for name in sorted(user_hist.keys()):
-            item = QListWidgetItem(name)
-            dp = self.load_profile_pixmap(name)
-            if dp:
-                item.setIcon(avatar_icon_for(name, dp, size=28, online=False))
-            else:
-                item.setIcon(self.make_status_icon(False))
-            self.chat_list.addItem(item)
+        self.chat_model.set_chats((name, activity_time(ts)) for name, ts in self.store.recent_peers(self.nickname))
 
-    def append_global_message(self, sender: str, recipient: str, message_text: str):
+    def append_global_message(self, sender: str, recipient: str, message_text: str, msg_id: str) -> bool:
         """
-        Appends a message safely with defensive merge against truncated history files.
+        Appends one message to the local store. Returns False if msg_id was already stored.
         """
-        with GLOBAL_CHAT_LOCK:
-            file_data = load_global_chat_history()
-            
-            # Use data loaded from disk, or memory if disk failed (first layer defense)
-            data = file_data if file_data is not None else self.global_history
-            
-            # --- DEFENSIVE MERGE LOGIC (Fix for recurrent truncation) ---
-            
-            # Check the history list for the specific conversation pair from the file/loaded data
-            data.setdefault(sender, {}).setdefault(recipient, [])
-            loaded_list = data[sender][recipient]
-            
-            # Check the same history list from the currently preserved in-memory state
-            self.global_history.setdefault(sender, {}).setdefault(recipient, [])
-            mem_list = self.global_history[sender][recipient]
-
-            # If the memory list is significantly longer, the loaded data was truncated/stale.
-            if len(mem_list) > len(loaded_list):
-                # Re-base the loaded data with the longer memory list (Fixes truncation)
-                data[sender][recipient] = mem_list
-                
-                # Symmetrically update the reverse direction using the memory's symmetric list
-                self.global_history.setdefault(recipient, {}).setdefault(sender, [])
-                data.setdefault(recipient, {})[sender] = self.global_history[recipient][sender]
-                print(f"Defensive Merge: Restored {len(mem_list)} messages for {sender} <-> {recipient} from memory before appending.")
-            # --- END DEFENSIVE MERGE ---
-            
-            # Ensure the symmetric recipient keys are present for appending
-            if sender != recipient:
-                data.setdefault(recipient, {}).setdefault(sender, [])
-
-            # --- DEDUPLICATION LOGIC ---
-            target_list = data[sender][recipient]
-            is_duplicate = False
-            if target_list:
-                last_msg = target_list[-1]
-                if last_msg['message'] == message_text and last_msg['sender'] == sender:
-                    is_duplicate = True
-            
-            if not is_duplicate:
-                entry = {"sender": sender, "message": message_text, "timestamp": datetime.now().isoformat()}
-                
-                # Append to both sides of the conversation (which now point to the longest history)
-                data[sender][recipient].append(entry)
-                if sender != recipient:
-                     data[recipient][sender].append(entry)
-                     
-                save_global_chat_history(data)
-                self.global_history = data
-            else:
-                # If duplicate, we still need self.global_history to be the current (merged) state
-                if data is not self.global_history:
-                     self.global_history = data
-                print(f"Duplicate message ignored: {message_text[:20]}...")
-
-        # UI update (signals) - unchanged
-        if recipient == self.nickname:
-            present = any(self.chat_list.item(i).text().split(' (')[0] == sender for i in range(self.chat_list.count()))
-            if not present:
-                it = QListWidgetItem(sender)
-                dp = self.load_profile_pixmap(sender)
-                icon = avatar_icon_for(sender, dp, size=28, online=False) if dp else self.make_status_icon(False)
-                self.add_chat_list_item_signal.emit(sender, icon)
-                
-        elif sender == self.nickname:
-            present = any(self.chat_list.item(i).text().split(' (')[0] == recipient for i in range(self.chat_list.count()))
-            if not present:
-                it = QListWidgetItem(recipient)
-                dp = self.load_profile_pixmap(recipient)
-                icon = avatar_icon_for(recipient, dp, size=28, online=False) if dp else self.make_status_icon(False)
-                self.add_chat_list_item_signal.emit(recipient, icon)
-
-    def load_local_chat(self, friend_name):
         try:
-            with GLOBAL_CHAT_LOCK:
-                # Ensure we read from the latest state in memory after on_chat_selected reload
-                history_list = self.global_history.get(self.nickname, {}).get(friend_name, [])
-                return history_list
-        except Exception:
+            peer = recipient if sender == self.nickname else sender
+            added = self.store.add(self.nickname, peer, msg_id, sender, message_text)
+        except sqlite3.Error as e:
+            print(f"Failed to store message: {e}")
+            added = True  # still show it; only persistence failed
+        if not added:
+            print(f"Duplicate message ignored: {message_text[:20]}...")
+            return False
+        return True  # the chat row is added / moved up by on_conversation_message
+
+    def load_local_chat(self, friend_name, before_seq=None):
+        try:
+            return self.store.conversation_page(self.nickname, friend_name, before_seq)
+        except sqlite3.Error:
             return []
 
     def clear_local_chat(self, friend_name):
         try:
-            with GLOBAL_CHAT_LOCK:
-                data = load_global_chat_history()
-                if data is None:
-                    data = self.global_history
-                    
-                changed = False
-                if self.nickname in data and friend_name in data[self.nickname]:
-                    data[self.nickname][friend_name] = []
-                    changed = True
-                if friend_name in data and self.nickname in data[friend_name]:
-                    data[friend_name][self.nickname] = []
-                    changed = True
-                    
-                if changed:
-                    save_global_chat_history(data)
-                    self.global_history = data
-                    return True
-        except Exception:
-            pass
-        return False
+            self.store.clear(self.nickname, friend_name)
+            self.conversations[friend_name] = []
+            self.oldest_seq[friend_name] = None
+            return True
+        except sqlite3.Error:
+            return False
 
     def filter_chats(self):
+        self.filter_rows(0, self.chat_model.rowCount() - 1)
+
+    def filter_rows(self, first: int, last: int):
         query = self.search_bar.text().lower()
-        for i in range(self.chat_list.count()):
-            item = self.chat_list.item(i)
-            item.setHidden(query not in item.text().lower())
+        for row in range(first, last + 1):
+            self.chat_list.setRowHidden(row, query not in self.chat_model.entries[row]["name"].lower())
+
+    def search_messages(self):
+        """Full-text search of the message history on the server, limited to the open chat if any."""
+        query = self.search_bar.text().strip()
+        if not query:
+            return
+        current = self.get_current_chat()
+        self.send_raw(f"/search {query} --in {current}" if current else f"/search {query}")
+
+    def show_search_results(self, result: dict):
+        hits = result.get("hits", [])
+        if not hits:
+            self.ai_display.append(f"No messages match '{result.get('query', '')}'.")
+            return
+        lines = [f"Search results for '{result.get('query', '')}':"]
+        for hit in hits:
+            file_info = parse_file_message(hit["message"])
+            text = f"📎 {file_info[1]}" if file_info else hit["message"][:80]
+            lines.append(f"[{hit['timestamp'][:16].replace('T', ' ')}] {hit['conversation']} | {hit['sender']}: {text}")
+        self.ai_display.append("\n".join(lines))
 
     def mark_unread(self, sender):
-        found = False
-        for i in range(self.chat_list.count()):
-            item = self.chat_list.item(i)
-            base = item.text().split(' (')[0]
-            if base == sender:
-                found = True
-                cnt = len(self.unread_local.get(sender, []))
-                if cnt:
-                    item.setText(f"{sender} ({cnt})")
-                else:
-                    item.setText(base)
-                break
-        if not found:
-            it = QListWidgetItem(f"{sender} ({len(self.unread_local.get(sender, []))})")
-            icon = self.make_status_icon(False)
-            self.add_chat_list_item_signal.emit(f"{sender} ({len(self.unread_local.get(sender, []))})", icon)
-
-    def refresh_chat_list_badges(self):
-        for i in range(self.chat_list.count()):
-            item = self.chat_list.item(i)
-            base = item.text().split(' (')[0]
-            cnt = len(self.unread_local.get(base, []))
-            if cnt:
-                item.setText(f"{base} ({cnt})")
-            else:
-                item.setText(base)
+        self.chat_model.update(sender, unread=self.unread_local.get(sender, 0))
 
     def respond_pending(self, index: int, accept: bool):
         try:
@@ -1390,8 +2456,7 @@ class AgenticChatApp(QMainWindow):
                 self.pending_list_widget.takeItem(index)
             except Exception:
                 pass
-            QTimer.singleShot(800, self.request_friends_list)
-            QTimer.singleShot(900, self.request_pending_list)
+            # the server answers an accept with a friend_added event
         except Exception as e:
             print("Failed to respond to pending:", e)
 
@@ -1408,12 +2473,9 @@ class AgenticChatApp(QMainWindow):
         reply = QMessageBox.question(self, "Friend Action", f"Open chat with {name}?", QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No)
         if reply == QMessageBox.StandardButton.Yes:
             self.stacked_widget.setCurrentWidget(self.chat_page)
-            for i in range(self.chat_list.count()):
-                it = self.chat_list.item(i)
-                if it.text().split(' (')[0] == name:
-                    self.chat_list.setCurrentItem(it)
-                    self.on_chat_selected(it)
-                    break
+            index = self.chat_model.index(self.chat_model.ensure(name))
+            self.chat_list.setCurrentIndex(index)
+            self.on_chat_selected(index)
 
     def upload_profile_picture(self):
         if not self.user_profile_dir or not self.user_profile_file or not self.nickname:
@@ -1433,6 +2495,8 @@ class AgenticChatApp(QMainWindow):
             )
             pixmap.save(dest, "PNG") 
             pixmap.save(public_dest, "PNG") 
+            self.forget_avatar(self.nickname)
+            threading.Thread(target=self.push_profile_picture, args=(public_dest,), daemon=True).start()
             
             self.profile_pic.setPixmap(pixmap)
             self.profile_pic.setStyleSheet("border-radius:60px;")
@@ -1446,10 +2510,9 @@ class AgenticChatApp(QMainWindow):
                 json.dump(data, f, indent=4)
 
     def on_chat_context_menu(self, pos: QPoint):
-        item = self.chat_list.itemAt(pos)
-        if not item:
+        friend = self.chat_model.name_at(self.chat_list.indexAt(pos))
+        if not friend:
             return
-        friend = item.text().split(' (')[0]
         menu = QMenu(self)
         act_sum = QAction('Summarize', self)
         act_play = QAction('PlayBook', self)
@@ -1521,42 +2584,25 @@ class AgenticChatApp(QMainWindow):
         self.file_mania_window.raise_()
         self.file_mania_window.activateWindow()
 
-    def handle_file_mania_action(self, file_path, action):
-        threading.Thread(target=self._upload_and_send_file_analysis, 
-                         args=(file_path, action), daemon=True).start()
-        
-    def _upload_and_send_file_analysis(self, file_path, action):
-        try:
-            url = f"http://{HOST}:{HTTP_PORT}/"
-            filename = os.path.basename(file_path)
-            mime_type, _ = mimetypes.guess_type(file_path)
-            if mime_type is None: mime_type = 'application/octet-stream'
-
-            with open(file_path, 'rb') as f:
-                file_data = f.read()          
-                headers = {'X-Filename': filename, 'Content-Type': mime_type}
-                
-                self.ai_indicator_signal.emit("FileMania", True)
-                
-                response = requests.post(url, data=file_data, headers=headers, timeout=300)
-            
+    def handle_file_mania_action(self, file_path, action, force=False):
+        def on_done(data):
             self.ai_indicator_signal.emit("FileMania", False) # Turn off when done
-            response.raise_for_status()
-            data = response.json()
-
-            if data.get("success"):
-                file_url = data.get("url")
-                command_payload = f"/FILEMANIA|{action}|{file_url}"
-                self.send_raw(command_payload)
-                
-            else:
-                raise Exception(data.get("error", "Unknown upload error"))
+            file_url = data.get("url")
+            command_payload = f"/FILEMANIA|{action}|{file_url}"
+            if force:
+                command_payload += "|force"
+            self.send_raw(command_payload)
 
-        except Exception as e:
+        def on_error(e):
             self.ai_indicator_signal.emit("FileMania", False)
+            if isinstance(e, TransferCancelled):
+                return
             print(f"FileMania operation failed: {e}")
             self.ui_message_signal.emit(f"File Analysis Failed: {e}", True, datetime.now().strftime('%H:%M'))
 
+        self.ai_indicator_signal.emit("FileMania", True)
+        self.transfers.submit_upload(file_path, self.http_token, on_done=on_done, on_error=on_error)
+
 # Entrypoint
 if __name__ == '__main__':
     from PyQt6.QtWidgets import QApplication
@@ -1,6 +1,13 @@
 import socket
+import sys
 import threading
 import json
+import re
+import bisect
+import heapq
+import weakref
+import signal
+from collections import OrderedDict
 from datetime import datetime, timedelta
 import requests
 import traceback
@@ -9,24 +16,74 @@ import os
 import http.server
 import socketserver
 from urllib.parse import unquote
+from email.utils import parsedate_to_datetime
 import hashlib 
+import time
+import uuid
+import gzip
+import shutil
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None  # Pillow is optional; image thumbnails are disabled without it
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None  # zstd downloads are offered only when zstandard is installed
 
 # --- CONFIGURATION ---
 HOST = '192.168.29.114'  # <--- MAKE SURE THIS MATCHES YOUR LOCAL IP
 PORT = 5000
 HTTP_PORT = 5001
 FILE_DIR = "server_files"
+USE_SENDFILE = hasattr(os, "sendfile")  # zero-copy downloads where the OS supports it
+THUMB_SIZE = 256
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.gif', '.webp')
+PROFILES_DIR = "profiles"
+MAX_AVATAR_SIZE = 5 * 1024 * 1024
+MAX_UPLOAD_SIZE = 50 * 1024 * 1024
+USER_QUOTA_BYTES = 1024 * 1024 * 1024
+FILE_GC_INTERVAL = 60 * 60  # seconds between storage GC passes
+ORPHAN_GRACE_PERIOD = timedelta(hours=24)  # unreferenced uploads (e.g. FileMania) live this long
+COMPRESSIBLE_TYPES = ('text/', 'application/json', 'application/xml', 'application/javascript', 'image/svg+xml')
+COMPRESSIBLE_EXTENSIONS = ('.txt', '.log', '.csv', '.tsv', '.json', '.ndjson', '.xml', '.md', '.html', '.js', '.svg')
+MIN_COMPRESS_SIZE = 1024
+FILEMANIA_WORKFLOW_VERSION = "1"  # bump when the n8n workflow changes so old analyses are not reused
+FILEMANIA_CACHE_TTL = timedelta(days=7)
+FILEMANIA_CACHE_MAX_ENTRIES = 500
+ENCODING_SUFFIXES = {"zstd": ".zst", "gzip": ".gz"}
+FRAME_SEPARATOR = b"\x1e"  # ASCII record separator; ends every chat protocol message in both directions
+MAX_FRAME_SIZE = 1024 * 1024  # bytes; a connection sending a longer frame is closed
+SUPPORTED_CAPS = {"json", "resume", "ack"}  # offered to clients that send CAPS|<cap,...> before LOGIN
+OFFLINE_PAGE_SIZE = 200  # stored messages sent per backlog page; acking clients get the next page after acking
+SAVE_DELAY = 1.0  # seconds; changes to a deferred file within this window are written once
+SEARCH_LIMIT = 20  # hits returned by /search
+DEDUP_WINDOW = 10000  # recent message IDs remembered, so a client retransmit is not delivered twice
 
 TEMP_PASS_FILE = "temporary_passwords.json"
 CHAT_FILE = "chat_history.json"
 FRIENDS_FILE = "friends_data.json"
 USERS_DB_FILE = "users_db.json"
+FILE_INDEX_FILE = "file_index.json"
+FILEMANIA_CACHE_FILE = "filemania_cache.json"
+DELIVERY_FILE = "delivery_cursors.json"
+UNREAD_FILE = "unread_state.json"
 
 chat_lock = threading.Lock()
+thumb_lock = threading.Lock()
+compress_lock = threading.Lock()
+file_index_lock = threading.Lock()
+filemania_lock = threading.Lock()
+search_lock = threading.Lock()
+unread_lock = threading.Lock()
 
 # Ensure directories exist
 if not os.path.exists(FILE_DIR):
     os.makedirs(FILE_DIR)
+if not os.path.exists(PROFILES_DIR):
+    os.makedirs(PROFILES_DIR)
 
 # --- HELPER FUNCTIONS ---
 
@@ -44,6 +101,55 @@ def save_json(file_path, data):
         with open(file_path, "w") as f:
             json.dump(data, f, indent=4)
 
+class DeferredSave:
+    """
+    Coalesces frequent rewrites of one file: request() only marks it changed, and
+    a background thread runs write() at most once per SAVE_DELAY. Whatever must
+    not be promised before it is on disk (e.g. SENT acks) goes in as on_saved and
+    runs after the write that includes the change. flush() writes pending changes
+    at shutdown.
+    """
+    def __init__(self, name, write):
+        self.name = name
+        self.write = write
+        self.dirty = threading.Event()
+        self.lock = threading.Lock()        # guards callbacks against the swap in flush
+        self.write_lock = threading.Lock()  # one write at a time (loop vs shutdown flush)
+        self.callbacks = []
+
+    def request(self, on_saved=None):
+        if on_saved:
+            with self.lock:
+                self.callbacks.append(on_saved)
+        self.dirty.set()
+
+    def flush(self):
+        with self.write_lock:
+            with self.lock:
+                if not self.dirty.is_set():
+                    return
+                self.dirty.clear()
+                callbacks, self.callbacks = self.callbacks, []
+            try:
+                self.write()
+            except Exception as e:
+                print(f"[SAVE] Could not write {self.name}: {e}")
+                with self.lock:
+                    self.callbacks[:0] = callbacks  # retried with the next write
+                self.dirty.set()
+                return
+        for callback in callbacks:
+            callback()
+
+    def loop(self):
+        while True:
+            self.dirty.wait()
+            time.sleep(SAVE_DELAY)
+            self.flush()
+
+    def start(self):
+        threading.Thread(target=self.loop, daemon=True).start()
+
 def load_temp_passwords():
     return load_json(TEMP_PASS_FILE)
 
@@ -58,38 +164,421 @@ def save_temp_passwords(data):
     except Exception as e:
         print("[TEMP PASS] Failed to save:", e)
 
+# ---------------- MESSAGE RECORDS ----------------
+# chat_history[a][b] and chat_history[b][a] are the same list, so each message is held once.
+# Records are compact ChatMessage objects; the JSON dict form of a message only exists while
+# the encoder writes it or a webhook payload is built.
+
+class ChatMessage:
+    __slots__ = ("id", "sender", "message", "timestamp", "ai")
+
+    def __init__(self, msg_id, sender, message, timestamp, ai=False):
+        self.id = msg_id
+        self.sender = sys.intern(sender)  # one string object per username
+        self.message = message
+        self.timestamp = timestamp        # integer epoch seconds
+        self.ai = ai
+
+    @classmethod
+    def from_dict(cls, d):
+        try:
+            timestamp = int(datetime.fromisoformat(d["timestamp"]).timestamp())
+        except (KeyError, TypeError, ValueError):
+            timestamp = 0
+        return cls(d.get("id") or uuid.uuid4().hex, d.get("sender", ""), d.get("message", ""),
+                   timestamp, bool(d.get("ai")))
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "sender": self.sender,
+            "message": self.message,
+            "timestamp": datetime.fromtimestamp(self.timestamp).isoformat(),
+            "ai": self.ai
+        }
+
+def conversation(a, b):
+    """The message list a and b share, created for both sides on first use."""
+    entries = chat_history.setdefault(sys.intern(a), {}).get(b)
+    if entries is None:
+        entries = chat_history.setdefault(sys.intern(b), {}).setdefault(sys.intern(a), [])
+        chat_history[a][sys.intern(b)] = entries
+    return entries
+
+def load_chat_history(path):
+    """Reads the per-direction JSON file into shared per-conversation lists of ChatMessage."""
+    history = {}
+    raw = load_json(path)
+    for a, convs in raw.items():
+        history.setdefault(sys.intern(a), {})
+        for b, entries in convs.items():
+            if b in history[a]:
+                continue  # linked when the other side was read
+            other = raw.get(b, {}).get(a, [])
+            # both sides are written together; should they differ, keep the fuller one
+            shared = [ChatMessage.from_dict(e) for e in (entries if len(entries) >= len(other) else other)]
+            history[a][sys.intern(b)] = shared
+            history.setdefault(sys.intern(b), {})[a] = shared
+    return history
+
+def write_chat_history():
+    """
+    Streams the history to CHAT_FILE straight from the records: the encoder asks
+    ChatMessage.to_dict for one message at a time, so no dict copy of the whole
+    history is ever built. chat_lock is held only while the conversation lists
+    are copied (references, each shared list once); the slow dump runs after it
+    is released. Only the history_saver thread writes this file.
+    """
+    with chat_lock:
+        copies = {}
+        snapshot = {}
+        for a, convs in list(chat_history.items()):
+            snapshot[a] = {}
+            for b, entries in list(convs.items()):
+                if id(entries) not in copies:
+                    copies[id(entries)] = list(entries)
+                snapshot[a][b] = copies[id(entries)]
+    tmp = CHAT_FILE + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(snapshot, f, default=ChatMessage.to_dict)
+    os.replace(tmp, CHAT_FILE)
+
+history_saver = DeferredSave(CHAT_FILE, write_chat_history)
+
+def save_chat_history():
+    """Messages are appended on every send; the file is rewritten in batches, off the send path."""
+    history_saver.request()
+
+def recent_messages(a, b, count):
+    """The last count messages of a conversation as JSON dicts, for webhook payloads."""
+    return [m.to_dict() for m in chat_history.get(a, {}).get(b, [])[-count:]]
+
 # Load persistent data initially
-chat_history = load_json(CHAT_FILE)
+chat_history = load_chat_history(CHAT_FILE)
 friends_data = load_json(FRIENDS_FILE)
 friends = friends_data.get("friends", {})
 pending_requests = friends_data.get("pending", {})
 
+# Offline delivery reads straight from chat_history: each user has a persisted cursor per
+# conversation (entries the client has stored) and, while online, a sent position (entries
+# written to the socket). Everything between the two is re-sent at the next login.
+delivery_cursors = load_json(DELIVERY_FILE)  # username -> {peer: entries of chat_history[username][peer] delivered}
+
+# Unread state is a counter and the last-read message ID per conversation, not message copies
+unread_state = load_json(UNREAD_FILE)
+unread_counts = unread_state.get("counts", {})  # username -> {peer: messages not read yet}
+last_read = unread_state.get("last_read", {})   # username -> {peer: msg_id read up to}
+
 # Global State
 clients = []
 nicknames = []
 online_status = {}
-unread_messages = {}
-offline_queue = {}
 auto_sessions = {}
+resume_tokens = {}     # token -> username, issued at LOGIN to clients with the resume capability
+http_tokens = {}       # token -> username, authorizes writes to the file server (X-Session-Token)
+session_caps = {}      # username -> caps of the online session
+delivery_sent = {}     # username -> {peer: entries written to the current session}
+backlog_open = set()   # users with more backlog pages to send once the last one is acked
+delivery_locks = {}    # username -> RLock over that user's positions and the MSG frames written to them
+write_locks = weakref.WeakKeyDictionary()  # client socket -> Lock held for each write, see send_frames
+write_locks_guard = threading.Lock()
+recent_message_ids = OrderedDict()  # msg_id -> None, the last DEDUP_WINDOW messages stored
+
+# ---------------- FILE STORAGE ----------------
+# Uploads are sharded by a hash prefix of their file ID (FILE_DIR/ab/cd/<file_id>)
+# so no directory grows without bound. file_index maps each file ID to its owner,
+# size, upload time, content hash and the conversations whose history references it.
+
+file_index = load_json(FILE_INDEX_FILE)
+owner_usage = {}
+files_by_hash = {}  # sha256 -> file_id, for hash-first uploads
+
+def shard_path(file_id):
+    digest = hashlib.sha1(file_id.encode('utf-8')).hexdigest()
+    return os.path.join(FILE_DIR, digest[:2], digest[2:4], file_id)
+
+def derived_paths(file_id):
+    """Cached files generated from an upload (previews etc.) that live and die with it."""
+    base = shard_path(file_id)
+    return [base + ".thumb.jpg"] + [base + suffix for suffix in ENCODING_SUFFIXES.values()]
+
+def conversation_key(a, b):
+    return ":".join(sorted([a, b]))
+
+def save_file_index():
+    with file_index_lock:
+        tmp = FILE_INDEX_FILE + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(file_index, f, indent=4)
+        os.replace(tmp, FILE_INDEX_FILE)
+
+def reserve_quota(owner, size):
+    """
+    Charges size to owner before the body is received, so concurrent uploads
+    cannot all pass the check. Returns False if it would exceed the quota.
+    """
+    with file_index_lock:
+        if owner_usage.get(owner, 0) + size > USER_QUOTA_BYTES:
+            return False
+        owner_usage[owner] = owner_usage.get(owner, 0) + size
+        return True
+
+def release_quota(owner, size):
+    """Returns a reservation of an upload that failed or was rejected."""
+    with file_index_lock:
+        owner_usage[owner] = max(0, owner_usage.get(owner, 0) - size)
+
+def register_upload(file_id, owner, size, sha256):
+    """Indexes a received upload; its size was already charged by reserve_quota."""
+    with file_index_lock:
+        file_index[file_id] = {
+            "owner": owner,
+            "size": size,
+            "uploaded": datetime.now().isoformat(),
+            "sha256": sha256,
+            "refs": []
+        }
+        files_by_hash[sha256] = file_id
+    save_file_index()
+
+def find_upload_by_hash(sha256):
+    """
+    Returns the file ID of a stored upload with this content hash, or None.
+    A hit counts as a fresh use, so the GC grace period restarts.
+    """
+    with file_index_lock:
+        file_id = files_by_hash.get(sha256)
+        if not file_id or file_id not in file_index or not os.path.exists(shard_path(file_id)):
+            return None
+        file_index[file_id]["last_used"] = datetime.now().isoformat()
+    save_file_index()
+    return file_id
+
+def add_file_ref(file_id, conv_key):
+    with file_index_lock:
+        entry = file_index.get(file_id)
+        if entry is None or conv_key in entry["refs"]:
+            return
+        entry["refs"].append(conv_key)
+    save_file_index()
+
+def drop_conversation_refs(conv_key):
+    """Called when a chat is cleared: its attachments become orphans unless shared elsewhere."""
+    changed = False
+    with file_index_lock:
+        for entry in file_index.values():
+            if conv_key in entry["refs"]:
+                entry["refs"].remove(conv_key)
+                changed = True
+    if changed:
+        save_file_index()
+
+def file_id_from_message(msg):
+    if not msg.startswith("FILE|"):
+        return None
+    parts = msg.split("|", 3)
+    return parts[1] if len(parts) == 4 else None
+
+def delete_upload(file_id):
+    """Removes an upload and its derived files. Caller holds file_index_lock."""
+    entry = file_index.pop(file_id, None)
+    if entry:
+        owner = entry.get("owner")
+        owner_usage[owner] = max(0, owner_usage.get(owner, 0) - entry.get("size", 0))
+        if files_by_hash.get(entry.get("sha256")) == file_id:
+            del files_by_hash[entry["sha256"]]
+    for path in [shard_path(file_id)] + derived_paths(file_id):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print(f"[FILE GC] Could not remove {path}: {e}")
+
+def init_file_storage():
+    """
+    Moves uploads from the old flat FILE_DIR layout into shards, indexes
+    anything unknown, and rebuilds references from the chat history.
+    """
+    for name in os.listdir(FILE_DIR):
+        old_path = os.path.join(FILE_DIR, name)
+        if not os.path.isfile(old_path):
+            continue
+        new_path = shard_path(name)
+        os.makedirs(os.path.dirname(new_path), exist_ok=True)
+        os.replace(old_path, new_path)
+        if name not in file_index:
+            fs = os.stat(new_path)
+            file_index[name] = {
+                "owner": None,
+                "size": fs.st_size,
+                "uploaded": datetime.fromtimestamp(fs.st_mtime).isoformat(),
+                "sha256": None,
+                "refs": []
+            }
+
+    for entry in file_index.values():
+        entry["refs"] = []
+    for a, convs in chat_history.items():
+        for b, msgs in convs.items():
+            for m in msgs:
+                file_id = file_id_from_message(m.message)
+                key = conversation_key(a, b)
+                if file_id in file_index and key not in file_index[file_id]["refs"]:
+                    file_index[file_id]["refs"].append(key)
+
+    owner_usage.clear()
+    files_by_hash.clear()
+    for file_id, entry in file_index.items():
+        owner_usage[entry["owner"]] = owner_usage.get(entry["owner"], 0) + entry["size"]
+        if entry.get("sha256"):
+            files_by_hash[entry["sha256"]] = file_id
+    save_file_index()
+
+def collect_file_garbage():
+    """Deletes uploads no conversation references once they are past the grace period."""
+    cutoff = datetime.now() - ORPHAN_GRACE_PERIOD
+    removed = 0
+    with file_index_lock:
+        for file_id, entry in list(file_index.items()):
+            if entry["refs"]:
+                continue
+            try:
+                uploaded = datetime.fromisoformat(entry.get("last_used") or entry["uploaded"])
+            except (TypeError, ValueError):
+                uploaded = cutoff
+            if uploaded <= cutoff or not os.path.exists(shard_path(file_id)):
+                delete_upload(file_id)
+                removed += 1
+    if removed:
+        save_file_index()
+        print(f"[FILE GC] Reclaimed {removed} orphaned upload(s)")
+
+def file_gc_loop():
+    while True:
+        try:
+            collect_file_garbage()
+        except Exception as e:
+            print(f"[FILE GC] Error: {e}")
+        time.sleep(FILE_GC_INTERVAL)
+
+# ---------------- THUMBNAILS ----------------
+
+def get_thumbnail(file_id):
+    """
+    Returns the path of the cached thumbnail for an image upload, generating it
+    on first use. Returns None for non-images or when Pillow is unavailable.
+    """
+    if Image is None or not file_id.lower().endswith(IMAGE_EXTENSIONS):
+        return None
+    src_path = shard_path(file_id)
+    thumb_path = derived_paths(file_id)[0]
+    if os.path.exists(thumb_path):
+        return thumb_path
+    if not os.path.isfile(src_path):
+        return None
+
+    with thumb_lock:
+        if os.path.exists(thumb_path):
+            return thumb_path
+        tmp = thumb_path + ".tmp"
+        try:
+            with Image.open(src_path) as img:
+                img.thumbnail((THUMB_SIZE, THUMB_SIZE))
+                img.convert("RGB").save(tmp, "JPEG", quality=80)
+            os.replace(tmp, thumb_path)
+        except Exception as e:
+            print(f"[FILE SERVER] Thumbnail failed for {file_id}: {e}")
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return None
+    return thumb_path
+
+# ---------------- COMPRESSION ----------------
+
+def is_compressible(file_id, content_type):
+    return content_type.startswith(COMPRESSIBLE_TYPES) or file_id.lower().endswith(COMPRESSIBLE_EXTENSIONS)
+
+def get_compressed_variant(file_id, encoding):
+    """
+    Returns the path of the cached gzip/zstd copy of an upload, compressing it
+    on the first request only. Returns None if the original is missing.
+    """
+    src_path = shard_path(file_id)
+    variant_path = src_path + ENCODING_SUFFIXES[encoding]
+    if os.path.exists(variant_path):
+        return variant_path
+    if not os.path.isfile(src_path):
+        return None
+
+    with compress_lock:
+        if os.path.exists(variant_path):
+            return variant_path
+        tmp = variant_path + ".tmp"
+        try:
+            with open(src_path, 'rb') as src, open(tmp, 'wb') as dst:
+                if encoding == "zstd":
+                    zstandard.ZstdCompressor(level=10).copy_stream(src, dst)
+                else:
+                    with gzip.GzipFile(fileobj=dst, mode='wb', compresslevel=6, mtime=0) as gz:
+                        shutil.copyfileobj(src, gz, 64 * 1024)
+            os.replace(tmp, variant_path)
+        except Exception as e:
+            print(f"[FILE SERVER] Compression failed for {file_id}: {e}")
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return None
+    return variant_path
+
+def file_etag(file_path, fs):
+    """
+    Strong ETag for a stored file. Uploads are never rewritten in place, so
+    the file ID plus size and mtime identify the exact bytes being served.
+    """
+    token = f"{os.path.basename(file_path)}:{fs.st_size}:{fs.st_mtime_ns}"
+    return '"' + hashlib.sha256(token.encode()).hexdigest()[:32] + '"'
 
 # ---------------- HTTP FILE SERVER ----------------
 
 class FileUploadHandler(http.server.SimpleHTTPRequestHandler):
+    use_sendfile = USE_SENDFILE
+
     def do_POST(self):
+        if self.path.startswith('/avatars/'):
+            self.handle_avatar_upload()
+            return
+        owner, reserved = None, 0
         try:
             content_length = int(self.headers['Content-Length'])
-            # SECURITY: Limit upload size to 50MB to prevent DoS
-            if content_length > 50 * 1024 * 1024:
+            # SECURITY: Limit upload size to prevent DoS
+            if content_length > MAX_UPLOAD_SIZE:
                 self.send_error(413, "File too large")
                 return
+
+            # Uploads are charged to the logged-in user, never to a name the client picks
+            owner = self.session_user()
+            if not owner:
+                self.send_error(401, "Login required")
+                return
+            if not reserve_quota(owner, content_length):
+                self.send_error(413, "Storage quota exceeded")
+                return
+            reserved = content_length
                 
             filename = unquote(self.headers.get('X-Filename', 'unknown_file'))
             filename = os.path.basename(filename)
             file_id = f"{datetime.now().strftime('%Y%m%d%H%M%S')}_{filename}"
-            file_path = os.path.join(FILE_DIR, file_id)
-
-            with open(file_path, 'wb') as f:
-                f.write(self.rfile.read(content_length))
+            file_path = shard_path(file_id)
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+
+            sha256 = self.receive_upload(file_path, content_length)
+            expected = self.headers.get('X-Content-SHA256')
+            if expected and expected.lower() != sha256:
+                os.remove(file_path)
+                self.send_error(400, "Content hash mismatch")
+                return
+            register_upload(file_id, owner, content_length, sha256)
+            reserved = 0
 
             self.send_response(200)
             self.send_header("Content-type", "application/json")
@@ -104,78 +593,718 @@ class FileUploadHandler(http.server.SimpleHTTPRequestHandler):
             self.wfile.write(json.dumps(response_data).encode('utf-8'))
             print(f"[FILE SERVER] Received file: {file_id}")
 
+            # Pre-render the chat preview so the first bubble doesn't wait on it
+            if Image is not None and file_id.lower().endswith(IMAGE_EXTENSIONS):
+                threading.Thread(target=get_thumbnail, args=(file_id,), daemon=True).start()
+
+        except ConnectionError as e:
+            print(f"[FILE SERVER] Upload aborted by client: {e}")
         except Exception as e:
             print(f"[FILE SERVER] Upload error: {e}")
             self.send_response(500)
             self.end_headers()
             self.wfile.write(json.dumps({"success": False, "error": str(e)}).encode('utf-8'))
+        finally:
+            if reserved:
+                release_quota(owner, reserved)
+
+    def receive_upload(self, file_path, content_length):
+        """
+        Streams the request body to file_path in chunks and returns its SHA-256.
+        A cancelled or dropped upload leaves no partial file behind.
+        """
+        sha = hashlib.sha256()
+        tmp = f"{file_path}.{threading.get_ident()}.part"
+        remaining = content_length
+        try:
+            with open(tmp, 'wb') as f:
+                while remaining > 0:
+                    chunk = self.rfile.read(min(remaining, 64 * 1024))
+                    if not chunk:
+                        raise ConnectionError("Upload ended early")
+                    f.write(chunk)
+                    sha.update(chunk)
+                    remaining -= len(chunk)
+            os.replace(tmp, file_path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        return sha.hexdigest()
 
     def do_GET(self):
         if self.path.startswith('/files/'):
+            filename = os.path.basename(unquote(self.path[len('/files/'):]))
+            file_path = shard_path(filename)
+            content_type = self.guess_type(file_path)
+            # Every response for a file with compressed variants depends on Accept-Encoding,
+            # the identity one included, so caches must not hand it to gzip-capable clients
+            vary = is_compressible(filename, content_type) and os.path.isfile(file_path) \
+                and os.path.getsize(file_path) >= MIN_COMPRESS_SIZE
+            encoding = self.negotiate_encoding() if vary else None
+            variant_path = get_compressed_variant(filename, encoding) if encoding else None
+            if variant_path:
+                self.serve_file(variant_path, attachment_name=filename,
+                                content_type=content_type, encoding=encoding, vary=True)
+            else:
+                self.serve_file(file_path, attachment_name=filename, content_type=content_type, vary=vary)
+        elif self.path.startswith('/thumbs/'):
+            file_id = os.path.basename(unquote(self.path[len('/thumbs/'):]))
+            thumb_path = get_thumbnail(file_id)
+            if not thumb_path:
+                self.send_error(404, "No preview available")
+                return
+            self.serve_file(thumb_path, content_type="image/jpeg")
+        elif self.path.startswith('/hash/'):
+            sha256 = os.path.basename(unquote(self.path[len('/hash/'):])).lower()
+            file_id = find_upload_by_hash(sha256)
+            if file_id:
+                response_data = {
+                    "exists": True,
+                    "file_id": file_id,
+                    "url": f"http://{HOST}:{HTTP_PORT}/files/{file_id}"
+                }
+            else:
+                response_data = {"exists": False}
+            body = json.dumps(response_data).encode('utf-8')
+            self.send_response(200)
+            self.send_header("Content-type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        elif self.path.startswith('/avatars/'):
+            nickname = os.path.basename(unquote(self.path[len('/avatars/'):]))
+            self.serve_file(os.path.join(PROFILES_DIR, f"{nickname}.png"), content_type="image/png")
+        else:
+            self.send_error(404, "Not found")
+
+    def session_user(self):
+        """The logged-in user behind the X-Session-Token header, or None."""
+        return http_tokens.get(self.headers.get('X-Session-Token', ''))
+
+    def handle_avatar_upload(self):
+        try:
+            nickname = os.path.basename(unquote(self.path[len('/avatars/'):]))
+            user = self.session_user()
+            if not user:
+                self.send_error(401, "Login required")
+                return
+            if nickname != user:
+                self.send_error(403, "You can only change your own avatar")
+                return
+            content_length = int(self.headers['Content-Length'])
+            if content_length > MAX_AVATAR_SIZE:
+                self.send_error(413, "Avatar too large")
+                return
+            avatar_path = os.path.join(PROFILES_DIR, f"{nickname}.png")
+            tmp = avatar_path + ".tmp"
+            with open(tmp, 'wb') as f:
+                f.write(self.rfile.read(content_length))
+            os.replace(tmp, avatar_path)
+
+            self.send_response(200)
+            self.send_header("Content-type", "application/json")
+            self.end_headers()
+            self.wfile.write(json.dumps({"success": True}).encode('utf-8'))
+            print(f"[FILE SERVER] Updated avatar: {nickname}")
+        except Exception as e:
+            print(f"[FILE SERVER] Avatar upload error: {e}")
+            self.send_error(500, "Avatar upload failed")
+
+    def negotiate_encoding(self):
+        """Picks zstd (when available) or gzip from the client's Accept-Encoding, or None."""
+        accepted = {}
+        for token in self.headers.get('Accept-Encoding', '').split(','):
+            name, _, params = token.strip().partition(';')
+            q = 1.0
+            if params.strip().startswith('q='):
+                try:
+                    q = float(params.strip()[2:])
+                except ValueError:
+                    q = 0.0
+            if name:
+                accepted[name.lower()] = q
+        if zstandard is not None and accepted.get("zstd", 0) > 0:
+            return "zstd"
+        if accepted.get("gzip", 0) > 0:
+            return "gzip"
+        return None
+
+    def is_not_modified(self, etag, mtime):
+        """Evaluates If-None-Match (preferred) or If-Modified-Since against the stored file."""
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match:
+            tags = [t.strip() for t in if_none_match.split(',')]
+            return '*' in tags or etag in tags
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since:
             try:
-                filename = os.path.basename(unquote(self.path[len('/files/'):]))
-                file_path = os.path.join(FILE_DIR, filename)
-                if not os.path.exists(file_path) or not os.path.isfile(file_path):
-                    self.send_error(404, "File not found")
-                    return
-                with open(file_path, 'rb') as f:
-                    self.send_response(200)
-                    self.send_header("Content-type", self.guess_type(file_path))
-                    fs = os.fstat(f.fileno())
-                    self.send_header("Content-Length", str(fs[6]))
+                since = parsedate_to_datetime(if_modified_since)
+            except (TypeError, ValueError):
+                return False
+            return int(mtime) <= since.timestamp()
+        return False
+
+    def serve_file(self, file_path, attachment_name=None, content_type=None, encoding=None, vary=False):
+        try:
+            if not os.path.exists(file_path) or not os.path.isfile(file_path):
+                self.send_error(404, "File not found")
+                return
+            with open(file_path, 'rb') as f:
+                fs = os.fstat(f.fileno())
+                etag = file_etag(file_path, fs)
+                if self.is_not_modified(etag, fs.st_mtime):
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    if vary:
+                        self.send_header("Vary", "Accept-Encoding")
                     self.send_header("Last-Modified", self.date_time_string(fs.st_mtime))
-                    self.send_header("Content-Disposition", f'attachment; filename="{filename}"')
                     self.end_headers()
-                    self.copyfile(f, self.wfile)
-            except Exception as e:
-                self.send_error(404, "File not found")
+                    return
+                self.send_response(200)
+                self.send_header("Content-type", content_type or self.guess_type(file_path))
+                self.send_header("Content-Length", str(fs[6]))
+                self.send_header("Last-Modified", self.date_time_string(fs.st_mtime))
+                self.send_header("ETag", etag)
+                self.send_header("Cache-Control", "no-cache")
+                if encoding:
+                    self.send_header("Content-Encoding", encoding)
+                if vary:
+                    self.send_header("Vary", "Accept-Encoding")
+                if attachment_name:
+                    self.send_header("Content-Disposition", f'attachment; filename="{attachment_name}"')
+                self.end_headers()
+                self.send_file_body(f, fs[6])
+        except Exception as e:
+            self.send_error(404, "File not found")
+
+    def send_file_body(self, f, length):
+        """
+        Streams an open file to the client. Plain-HTTP sockets go through
+        socket.sendfile (kernel zero-copy); TLS sockets or a disabled
+        USE_SENDFILE fall back to the buffered copyfile path.
+        """
+        if self.use_sendfile and not isinstance(self.connection, ssl.SSLSocket):
+            self.connection.sendfile(f, 0, length)
         else:
-            self.send_error(404, "Not found")
+            self.copyfile(f, self.wfile)
 
 def start_file_server():
     # Pass directory explicitly to fix 404s
     handler_with_args = lambda *args, **kwargs: FileUploadHandler(*args, directory=FILE_DIR, **kwargs)
-    with socketserver.TCPServer(("", HTTP_PORT), handler_with_args) as httpd:
+    # Threaded so parallel client transfers don't queue behind each other
+    with socketserver.ThreadingTCPServer(("", HTTP_PORT), handler_with_args) as httpd:
+        httpd.daemon_threads = True
         print(f"[FILE SERVER] Serving on port {HTTP_PORT} from {FILE_DIR}")
         httpd.serve_forever()
 
-threading.Thread(target=start_file_server, daemon=True).start()
+# ---------------- FILEMANIA CACHE ----------------
+# Analyses are keyed by (content hash, action, workflow version): the same document
+# analysed the same way returns the stored reply instead of re-running the webhook.
+# Entries expire after FILEMANIA_CACHE_TTL; the least recently used are evicted first.
+
+filemania_cache = OrderedDict(load_json(FILEMANIA_CACHE_FILE))
+
+def filemania_cache_key(file_url, action):
+    file_id = os.path.basename(unquote(file_url.split('/files/', 1)[-1]))
+    with file_index_lock:
+        sha256 = file_index.get(file_id, {}).get("sha256")
+    if not sha256:
+        return None
+    return f"{sha256}:{action}:{FILEMANIA_WORKFLOW_VERSION}"
+
+def save_filemania_cache():
+    tmp = FILEMANIA_CACHE_FILE + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(filemania_cache, f, indent=4)
+    os.replace(tmp, FILEMANIA_CACHE_FILE)
+
+def get_cached_filemania_reply(key):
+    with filemania_lock:
+        entry = filemania_cache.get(key)
+        if entry is None:
+            return None
+        if datetime.fromisoformat(entry["created"]) + FILEMANIA_CACHE_TTL < datetime.now():
+            del filemania_cache[key]
+            return None
+        filemania_cache.move_to_end(key)
+        return entry["reply"]
+
+def store_filemania_reply(key, reply):
+    with filemania_lock:
+        filemania_cache[key] = {"reply": reply, "created": datetime.now().isoformat()}
+        filemania_cache.move_to_end(key)
+        while len(filemania_cache) > FILEMANIA_CACHE_MAX_ENTRIES:
+            filemania_cache.popitem(last=False)
+        save_filemania_cache()
+
+# ---------------- SEARCH INDEX ----------------
+# Inverted index over message text: token -> conversation key -> messages containing it.
+# The sorted vocabulary answers prefix queries with bisect, so a search touches only the
+# postings of matching tokens, never the history itself. Kept current by send_private and
+# /clear, rebuilt from chat_history at startup.
+
+TOKEN_RE = re.compile(r"[^\W_]+")  # words and numbers; "_" splits file names too
+search_postings = {}     # token -> {conversation_key: [ChatMessage]}
+search_vocabulary = []   # sorted tokens, for prefix lookups
+
+def tokenize(text):
+    """Distinct lowercase word tokens; shared files are indexed by their file name."""
+    if text.startswith("FILE|"):
+        parts = text.split("|", 3)
+        text = parts[2] if len(parts) > 2 else ""
+    return set(TOKEN_RE.findall(text.lower()))
+
+def add_postings(conv_key, message):
+    """Record message under each of its tokens; returns the tokens new to the index. Caller holds search_lock."""
+    new_tokens = []
+    for token in tokenize(message.message):
+        convs = search_postings.get(token)
+        if convs is None:
+            convs = search_postings[token] = {}
+            new_tokens.append(token)
+        convs.setdefault(conv_key, []).append(message)
+    return new_tokens
+
+def index_message(conv_key, message):
+    with search_lock:
+        for token in add_postings(conv_key, message):
+            bisect.insort(search_vocabulary, token)
+
+def unindex_conversation(conv_key, messages):
+    with search_lock:
+        for token in set().union(*(tokenize(m.message) for m in messages)):
+            convs = search_postings.get(token)
+            if convs is None:
+                continue
+            convs.pop(conv_key, None)
+            if not convs:
+                del search_postings[token]
+                del search_vocabulary[bisect.bisect_left(search_vocabulary, token)]
+
+def rebuild_search_index():
+    with search_lock:
+        search_postings.clear()
+        vocabulary = set()
+        seen = set()
+        for a, convs in chat_history.items():
+            for b, entries in convs.items():
+                if id(entries) in seen:
+                    continue  # both sides share one list
+                seen.add(id(entries))
+                conv_key = conversation_key(a, b)
+                for message in entries:
+                    vocabulary.update(add_postings(conv_key, message))
+        search_vocabulary[:] = sorted(vocabulary)  # one sort instead of an insort per term
+
+def expand_token(token):
+    """Indexed tokens equal to or starting with token, as (token, exact)."""
+    i = bisect.bisect_left(search_vocabulary, token)
+    while i < len(search_vocabulary) and search_vocabulary[i].startswith(token):
+        yield search_vocabulary[i], search_vocabulary[i] == token
+        i += 1
+
+def search_messages(username, query, friend=None):
+    """
+    Messages of username's conversations (or only the one with friend) that match
+    every query word, either exactly or as a prefix. Exact matches score 2 and
+    prefix matches 1; ties go to the newest message.
+    """
+    words = sorted(tokenize(query))
+    if not words:
+        return []
+    peers = [friend] if friend else list(chat_history.get(username, {}))
+    conv_keys = {conversation_key(username, p): p for p in peers}
+    scores = None
+    with search_lock:
+        for word in words:
+            word_scores = {}
+            for token, exact in expand_token(word):
+                convs = search_postings[token]
+                for conv_key in conv_keys.keys() & convs.keys():
+                    for message in convs[conv_key]:
+                        if word_scores.get(message, (0,))[0] < (2 if exact else 1):
+                            word_scores[message] = (2 if exact else 1, conv_key)
+            if scores is None:
+                scores = {m: [w, k] for m, (w, k) in word_scores.items()}
+            else:
+                scores = {m: [scores[m][0] + w, k] for m, (w, k) in word_scores.items() if m in scores}
+            if not scores:
+                return []
+    best = heapq.nlargest(SEARCH_LIMIT, scores.items(), key=lambda item: (item[1][0], item[0].timestamp))
+    return [{
+        "conversation": conv_keys[conv_key],
+        "conversation_id": conv_key,
+        "id": message.id,
+        "sender": message.sender,
+        "message": message.message,
+        "timestamp": datetime.fromtimestamp(message.timestamp).isoformat(),
+        "score": score
+    } for message, (score, conv_key) in best]
 
 # ---------------- CHAT LOGIC ----------------
 
+def write_lock(client):
+    with write_locks_guard:
+        lock = write_locks.get(client)
+        if lock is None:
+            lock = write_locks[client] = threading.Lock()
+        return lock
+
+def send_frames(client, frames):
+    """
+    The only way frames reach a client socket. Replies, events and deliveries are
+    written from different threads; one lock per connection keeps each sendall
+    whole, which an SSL socket does not guarantee by itself. False once the
+    connection is gone.
+    """
+    try:
+        data = b"".join(f.encode('utf-8').replace(FRAME_SEPARATOR, b"") + FRAME_SEPARATOR for f in frames)
+        with write_lock(client):
+            client.sendall(data)
+        return True
+    except Exception:
+        return False
+
 def send_message(msg, client):
+    send_frames(client, [msg])
+
+def push_event(username, event_type, **data):
+    """Pushes a typed EVENT|{json} frame to a user if they are online."""
+    if username not in nicknames:
+        return
     try:
-        client.send(msg.encode('utf-8'))
-    except:
-        pass 
+        client = clients[nicknames.index(username)]
+    except (ValueError, IndexError):
+        return
+    data["type"] = event_type
+    send_message("EVENT|" + json.dumps(data, ensure_ascii=False), client)
+
+def send_ai_result(client, caps, source, text, status="done"):
+    """AI job output: an AI|{json} frame for clients that negotiated json, the plain text otherwise."""
+    if "json" in caps:
+        send_message("AI|" + json.dumps({"source": source, "status": status, "text": text}, ensure_ascii=False), client)
+    else:
+        send_message(text, client)
+
+def write_unread_state():
+    """Atomic rewrite under unread_lock, so a send never waits on a history dump holding chat_lock."""
+    snapshot = {
+        "counts": {user: dict(counts) for user, counts in list(unread_counts.items())},
+        "last_read": {user: dict(ids) for user, ids in list(last_read.items())},
+    }
+    tmp = UNREAD_FILE + ".tmp"
+    with unread_lock:
+        with open(tmp, "w") as f:
+            json.dump(snapshot, f, indent=4)
+        os.replace(tmp, UNREAD_FILE)
+
+unread_saver = DeferredSave(UNREAD_FILE, write_unread_state)
+
+def save_unread_state():
+    """Counters change on every send and read; they reach the disk in batches."""
+    unread_saver.request()
+
+def mark_read(username, peer, msg_id=None):
+    """Reads a conversation up to msg_id (default: its last message); later incoming messages stay unread."""
+    entries = chat_history.get(username, {}).get(peer, [])
+    remaining = 0
+    if msg_id:
+        # walk back from the end: only the messages still unread are visited
+        for entry in reversed(entries):
+            if entry.id == msg_id:
+                break
+            if entry.sender != username and not entry.ai:  # AI replies are never counted as unread
+                remaining += 1
+        else:
+            remaining = 0  # unknown ID (e.g. cleared history): treat everything as read
+    else:
+        msg_id = entries[-1].id if entries else None
+    unread_counts.setdefault(username, {})[peer] = remaining
+    if msg_id:
+        last_read.setdefault(username, {})[peer] = msg_id
+    save_unread_state()
+
+def friends_records(username):
+    return [{"name": f, "online": online_status.get(f, False),
+             "unread": unread_counts.get(username, {}).get(f, 0)}
+            for f in friends.get(username, [])]
+
+def notify_presence(username, online):
+    for friend in friends.get(username, []):
+        push_event(friend, "presence", name=username, online=online)
+
+def session_snapshot(username):
+    """Full friends/pending state sent once at login; later changes arrive as events."""
+    return {
+        "friends": friends_records(username),
+        "pending": list(pending_requests.get(username, [])),
+        # every conversation, friends or not, in one go
+        "unread": {peer: n for peer, n in unread_counts.get(username, {}).items() if n},
+        "last_read": dict(last_read.get(username, {})),
+    }
+
+def issue_resume_token(username):
+    """One live token per user; a new login replaces the previous one."""
+    for token, user in list(resume_tokens.items()):
+        if user == username:
+            del resume_tokens[token]
+    token = uuid.uuid4().hex
+    resume_tokens[token] = username
+    return token
+
+def issue_http_token(username, fresh):
+    """File-server credential; a password login replaces it, a resume keeps it so transfers in flight stay valid."""
+    for token, user in list(http_tokens.items()):
+        if user == username:
+            if not fresh:
+                return token
+            del http_tokens[token]
+    token = uuid.uuid4().hex
+    http_tokens[token] = username
+    return token
+
+def login_reply(prefix, caps, username):
+    """LOGIN_OK / RESUME_OK, carrying the negotiated caps, the file-server token and a resume token when asked for."""
+    if not caps:
+        return prefix
+    info = {"caps": sorted(caps), "http_token": issue_http_token(username, fresh=prefix == "LOGIN_OK")}
+    if "resume" in caps:
+        info["resume"] = issue_resume_token(username)
+    return f"{prefix}|" + json.dumps(info)
+
+def reject_message(client, caps, msg_id, reason):
+    """Final answer to a message the server will not store; older clients get the reason as text."""
+    if msg_id and "ack" in caps:
+        send_message(f"REJECTED|{msg_id}|{reason}", client)
+    else:
+        send_message(reason, client)
+
+def write_delivery_cursors():
+    save_json(DELIVERY_FILE, {user: dict(cursors) for user, cursors in list(delivery_cursors.items())})
+
+delivery_saver = DeferredSave(DELIVERY_FILE, write_delivery_cursors)
+
+def save_delivery_cursors():
+    """Cursors move on every ACK and live message; they reach the disk in batches. A cursor
+    lost in a crash only re-sends messages the client already stores by ID."""
+    delivery_saver.request()
+
+def seed_delivery_cursors():
+    """
+    Runs at startup, but only the first time, when there is no cursor file yet. The
+    history stored up to then went out through the old in-memory offline queue, so
+    every conversation starts out delivered. Cursors that appear later start at 0.
+    """
+    if os.path.exists(DELIVERY_FILE):
+        return
+    for user, convs in chat_history.items():
+        delivery_cursors[user] = {peer: len(entries) for peer, entries in convs.items()}
+    write_delivery_cursors()
 
-def send_private(sender, recipient, msg, ai_generated=False):
+def delivery_lock(username):
+    """
+    Serializes delivery to one user: backlog pages (on the user's own thread, after
+    an ACK) and live messages (on the sender's thread) read and move the same
+    positions and write to the same socket.
+    """
+    return delivery_locks.setdefault(username, threading.RLock())
+
+def client_acks(username):
+    """Clients with the resume capability ACK what they stored; for others, sent means delivered."""
+    return "resume" in session_caps.get(username, ())
+
+def skip_own(username, peer, pos):
+    """The user's own messages never need delivering to them; positions step over them."""
+    entries = chat_history.get(username, {}).get(peer, [])
+    while pos < len(entries) and entries[pos].sender == username:
+        pos += 1
+    return pos
+
+def ack_delivery(username, peer, msg_id):
+    """Moves the user's cursor in a conversation past msg_id; only unacked entries are searched."""
+    with delivery_lock(username):
+        entries = chat_history.get(username, {}).get(peer, [])
+        cursors = delivery_cursors.setdefault(username, {})
+        start = min(cursors.get(peer, 0), len(entries))
+        for i in range(len(entries) - 1, start - 1, -1):
+            if entries[i].id == msg_id:
+                cursors[peer] = skip_own(username, peer, i + 1)
+                save_delivery_cursors()
+                break
+        if username in backlog_open and not awaiting_ack(username):
+            deliver_backlog(username)
+
+def awaiting_ack(username):
+    """True while an incoming message written to the session is not acked yet (at most one page).
+    Caller holds delivery_lock(username)."""
+    cursors = delivery_cursors.get(username, {})
+    for peer, pos in delivery_sent.get(username, {}).items():
+        entries = chat_history.get(username, {}).get(peer, [])
+        if any(e.sender != username for e in entries[cursors.get(peer, 0):pos]):
+            return True
+    return False
+
+def start_delivery(username):
+    """Session start: nothing is in flight yet, so sending resumes from the durable cursors."""
+    with delivery_lock(username):
+        # no cursor yet (see seed_delivery_cursors): the user has not been sent anything, start at 0
+        delivery_sent[username] = dict(delivery_cursors.setdefault(username, {}))
+        deliver_backlog(username)
+
+def deliver_backlog(username):
+    """
+    Writes the next OFFLINE_PAGE_SIZE stored messages past the sent positions in one
+    send. Acking clients get the following page once this one is acked; for the
+    others every page goes out now and the cursors move with it.
+    """
+    with delivery_lock(username):
+        if username not in nicknames:
+            return
+        client = clients[nicknames.index(username)]
+        sent = delivery_sent.setdefault(username, {})
+        while True:
+            frames = []
+            for peer, entries in chat_history.get(username, {}).items():
+                pos = min(sent.get(peer, 0), len(entries))
+                while pos < len(entries) and len(frames) < OFFLINE_PAGE_SIZE:
+                    entry = entries[pos]
+                    pos += 1
+                    if entry.sender != username:
+                        frames.append(f"MSG|{entry.id}|{entry.sender}|{entry.message}")
+                sent[peer] = pos
+                if len(frames) == OFFLINE_PAGE_SIZE:
+                    break
+            if frames and not send_frames(client, frames):
+                return  # the positions are rolled back to the cursors at the next session start
+            full = len(frames) == OFFLINE_PAGE_SIZE
+            if client_acks(username):
+                if full:
+                    backlog_open.add(username)
+                else:
+                    backlog_open.discard(username)
+                return
+            delivery_cursors[username] = dict(sent)
+            if not full:
+                save_delivery_cursors()
+                return
+
+def deliver_live(recipient, sender):
+    """
+    Sends a just-stored message now, together with anything else that reached the
+    conversation past the sent position. While backlog pages are open it goes out
+    with them instead, in order.
+    """
+    with delivery_lock(recipient):
+        if recipient in backlog_open or recipient not in delivery_sent:
+            return  # a page, or start_delivery for a session still being set up, sends it
+        try:
+            client = clients[nicknames.index(recipient)]
+        except (ValueError, IndexError):
+            return
+        entries = conversation(recipient, sender)
+        sent = delivery_sent[recipient]
+        pos = min(sent.get(sender, 0), len(entries))
+        frames = [f"MSG|{e.id}|{e.sender}|{e.message}" for e in entries[pos:] if e.sender != recipient]
+        sent[sender] = len(entries)
+        if frames and not send_frames(client, frames):
+            return
+        if not client_acks(recipient):
+            delivery_cursors.setdefault(recipient, {})[sender] = len(entries)
+            save_delivery_cursors()
+
+def advance_own(username, peer):
+    """After the user sends a message, caught-up positions step over it."""
+    with delivery_lock(username):
+        entries = chat_history.get(username, {}).get(peer, [])
+        for positions in (delivery_sent.get(username), delivery_cursors.get(username)):
+            if positions is not None and positions.get(peer, 0) == len(entries) - 1:
+                positions[peer] = len(entries)
+
+def drop_stale_session(username):
+    """Closes a connection the server has not noticed is dead yet, e.g. before a resume."""
+    if username not in nicknames:
+        return
+    with delivery_lock(username):
+        delivery_sent.pop(username, None)  # nothing goes to the new session before start_delivery
+    idx = nicknames.index(username)
+    old = clients.pop(idx)
+    nicknames.pop(idx)
+    try:
+        old.close()
+    except Exception:
+        pass
+
+class FrameReader:
+    """Splits one client's byte stream into messages, however TCP happened to chunk it."""
+    def __init__(self, client):
+        self.client = client
+        self.buffer = bytearray()  # bytes of the unfinished frame; already searched for FRAME_SEPARATOR
+        self.frames = []
+
+    def next_frame(self):
+        """
+        Returns the next message, or None once the client has disconnected or
+        sent a frame over MAX_FRAME_SIZE. Only newly received bytes are searched
+        for the separator.
+        """
+        while not self.frames:
+            data = self.client.recv(4096)
+            if not data:
+                return None
+            start = 0
+            end = data.find(FRAME_SEPARATOR)
+            while end != -1:
+                self.buffer += data[start:end]
+                if self.buffer:
+                    self.frames.append(bytes(self.buffer))
+                    self.buffer.clear()
+                start = end + 1
+                end = data.find(FRAME_SEPARATOR, start)
+            self.buffer += data[start:]
+            if len(self.buffer) > MAX_FRAME_SIZE:
+                print(f"[PROTOCOL] Frame over {MAX_FRAME_SIZE} bytes, closing the connection")
+                return None
+        return self.frames.pop(0).decode('utf-8', errors='replace')
+
+def remember_message_id(msg_id):
+    recent_message_ids[msg_id] = None
+    while len(recent_message_ids) > DEDUP_WINDOW:
+        recent_message_ids.popitem(last=False)
+
+def seed_recent_message_ids():
+    """Refills the dedup window from the tail of the stored history after a restart."""
+    for convs in chat_history.values():
+        for entries in convs.values():
+            for entry in entries[-100:]:
+                remember_message_id(entry.id)
+
+def send_private(sender, recipient, msg, ai_generated=False, msg_id=None):
     """Deliver private messages with proper AI handling and persistence."""
-    
-    # 1. Deliver to recipient if online
+    # Clients name their own messages so every copy of one message shares an ID
+    msg_id = msg_id or uuid.uuid4().hex
+    remember_message_id(msg_id)
+
+    # 1. Save History; offline recipients get the message from here at their next login
+    file_id = file_id_from_message(msg)
+    if file_id:
+        add_file_ref(file_id, conversation_key(sender, recipient))
+    message = ChatMessage(msg_id, sender, msg, int(time.time()), ai_generated)
+    conversation(sender, recipient).append(message)
+    save_chat_history()
+    index_message(conversation_key(sender, recipient), message)
+    advance_own(sender, recipient)
+
+    # 2. Deliver to recipient if online
     if recipient in nicknames:
-        try:
-            idx = nicknames.index(recipient)
-            send_message(f"{sender}|{msg}", clients[idx])
-        except Exception:
-            pass
-    else:
-        offline_queue.setdefault(recipient, {}).setdefault(sender, []).append(msg)
+        deliver_live(recipient, sender)
 
-    # 2. Mark unread (only humans)
+    # 3. Mark unread (only humans)
     if not ai_generated:
-        unread_messages.setdefault(recipient, {}).setdefault(sender, []).append(msg)
-
-    # 3. Save History
-    for a, b in [(sender, recipient), (recipient, sender)]:
-        chat_history.setdefault(a, {}).setdefault(b, [])
-        chat_history[a][b].append({
-            "sender": sender,
-            "message": msg,
-            "timestamp": datetime.now().isoformat(),
-            "ai": ai_generated
-        })
-    save_json(CHAT_FILE, chat_history)
+        counts = unread_counts.setdefault(recipient, {})
+        counts[sender] = counts.get(sender, 0) + 1
+        save_unread_state()
+        push_event(recipient, "unread", name=sender, count=counts[sender])
 
     # 4. AutoAI Logic
     if ai_generated:
@@ -203,7 +1332,7 @@ def send_private(sender, recipient, msg, ai_generated=False):
         "sender": activator,
         "recipient": target,
         "latest_message": msg,
-        "recent_messages": chat_history.get(activator, {}).get(target, [])[-20:]
+        "recent_messages": recent_messages(activator, target, 20)
     }
 
     def call_n8n_webhook():
@@ -233,19 +1362,37 @@ def handle_client(client):
     Handles Authentication -> Session Setup -> Main Chat Loop
     """
     authenticated_user = None
+    reader = FrameReader(client)
+    caps = set()  # negotiated response formats, see SUPPORTED_CAPS
+    resumed = False
     
     try:
         # === PHASE 1: AUTHENTICATION ===
         while True:
             try:
-                msg = client.recv(1024).decode('utf-8')
-                if not msg:
+                msg = reader.next_frame()
+                if msg is None:
                     client.close()
                     return
             except:
                 client.close()
                 return
 
+            if msg.startswith("CAPS|"):
+                caps = {c.strip() for c in msg[len("CAPS|"):].split(",")} & SUPPORTED_CAPS
+                continue
+
+            # RESUME|<token>: reconnect after a dropped connection without a password round trip
+            if msg.startswith("RESUME|"):
+                username = resume_tokens.pop(msg[len("RESUME|"):].strip(), None)
+                if not username:
+                    send_message("RESUME_FAIL", client)  # client falls back to LOGIN
+                    continue
+                send_message(login_reply("RESUME_OK", caps | {"resume"}, username), client)
+                authenticated_user = username
+                resumed = True
+                break
+
             if msg.startswith("LOGIN|"):
                 try:
                     _, username, password = msg.split("|", 2)
@@ -278,7 +1425,7 @@ def handle_client(client):
                             send_message("FIRST_LOGIN|OK", client)
                             # Stay in loop to wait for CHANGE_PASS
                         else:
-                            send_message("LOGIN_OK", client)
+                            send_message(login_reply("LOGIN_OK", caps, username), client)
                             authenticated_user = username
                             break # Go to Chat Phase
                     else:
@@ -319,26 +1466,28 @@ def handle_client(client):
                 pass
 
         # === PHASE 2: SESSION SETUP ===
-        print(f"[NEW SESSION] {authenticated_user} logged in.")
+        print(f"[{'RESUMED' if resumed else 'NEW'} SESSION] {authenticated_user} logged in.")
         
+        drop_stale_session(authenticated_user)
         nicknames.append(authenticated_user)
         clients.append(client)
         online_status[authenticated_user] = True
+        session_caps[authenticated_user] = caps
         
         friends.setdefault(authenticated_user, [])
         pending_requests.setdefault(authenticated_user, [])
-        unread_messages.setdefault(authenticated_user, {})
-        chat_history.setdefault(authenticated_user, {})
-        save_json(CHAT_FILE, chat_history)
+        unread_counts.setdefault(authenticated_user, {})
+        chat_history.setdefault(sys.intern(authenticated_user), {})
+        save_chat_history()
 
-        send_message(f"Welcome {authenticated_user}!\nConnected. Type /help for commands.", client)
-        
-        # Deliver Offline Messages
-        if authenticated_user in offline_queue:
-            for sender, msgs in offline_queue[authenticated_user].items():
-                for m in msgs:
-                    send_message(f"{sender}|{m}", client)
-            del offline_queue[authenticated_user]
+        if not resumed:
+            send_message(f"Welcome {authenticated_user}!\nConnected. Type /help for commands.", client)
+
+        # Deliver everything past the cursors: offline backlog, and on resume whatever the old link lost
+        start_delivery(authenticated_user)
+
+        push_event(authenticated_user, "snapshot", **session_snapshot(authenticated_user))
+        notify_presence(authenticated_user, True)
 
         # === PHASE 3: MAIN CHAT LOOP ===
         # Alias 'nickname' to 'authenticated_user' to keep original logic working
@@ -347,8 +1496,8 @@ def handle_client(client):
 
         while True:
             try:
-                msg = client.recv(1024).decode('utf-8')
-                if not msg:
+                msg = reader.next_frame()
+                if msg is None:
                     break
 
                 # ---------------- AUTO MODE ----------------
@@ -377,7 +1526,7 @@ def handle_client(client):
                     expires = datetime.now() + timedelta(minutes=duration if duration > 0 else 9999)
                     key = f"{nickname}:{target}"
                     auto_sessions[key] = {"active": True, "expires": expires}
-                    send_message(f"✅ AutoAI enabled for {target} {'for '+parts[2] if duration else '(until turned off)'}", client)
+                    send_ai_result(client, caps, "AutoAI", f"✅ AutoAI enabled for {target} {'for '+parts[2] if duration else '(until turned off)'}")
                     continue
 
                 elif msg.startswith("/noAuto"):
@@ -390,18 +1539,24 @@ def handle_client(client):
                     if key in auto_sessions:
                         auto_sessions[key]["active"] = False
                         auto_sessions.pop(key, None)
-                        send_message(f"❌ AutoAI disabled for {target}.", client)
+                        send_ai_result(client, caps, "AutoAI", f"❌ AutoAI disabled for {target}.")
                     else:
-                        send_message(f"No active AutoAI session with {target}.", client)
+                        send_ai_result(client, caps, "AutoAI", f"No active AutoAI session with {target}.", status="error")
+                    continue
+
+                # ACK|<sender>|<msg_id>: the client has stored everything up to msg_id from sender
+                elif msg.startswith("ACK|"):
+                    parts = msg.split("|", 2)
+                    if len(parts) == 3:
+                        ack_delivery(nickname, parts[1], parts[2])
                     continue
 
+                # /clearunread <friend> [msg_id]: read up to msg_id, or the whole conversation
                 elif msg.startswith("/clearunread"):
                     parts = msg.split()
                     if len(parts) < 2:
                         continue
-                    friend_name = parts[1].strip()
-                    if nickname in unread_messages and friend_name in unread_messages[nickname]:
-                        unread_messages[nickname][friend_name] = []
+                    mark_read(nickname, parts[1].strip(), parts[2] if len(parts) > 2 else None)
                     continue
 
                 elif msg.startswith("/summarize"):
@@ -411,10 +1566,10 @@ def handle_client(client):
                         continue
                     target = parts[1]
 
-                    recent_msgs = chat_history.get(nickname, {}).get(target, [])[-50:]
+                    recent_msgs = recent_messages(nickname, target, 50)
 
                     if not recent_msgs:
-                        send_message(f"No recent messages with {target} to summarize.", client)
+                        send_ai_result(client, caps, "Summarizer", f"No recent messages with {target} to summarize.", status="error")
                         continue
 
                     payload = {
@@ -431,9 +1586,9 @@ def handle_client(client):
                         )
                         result = r.json()
                         summary = result.get("summary", None) or result.get("reply", "(No summary received)")
-                        send_message(f"🧾 Summary of chat with {target}:\n\n{summary}", client)
+                        send_ai_result(client, caps, "Summarizer", f"🧾 Summary of chat with {target}:\n\n{summary}")
                     except Exception as e:
-                        send_message(f"⚠️ Error generating summary: {e}", client)
+                        send_ai_result(client, caps, "Summarizer", f"⚠️ Error generating summary: {e}", status="error")
                     continue  
 
                 elif msg.startswith("/helper"):
@@ -448,7 +1603,7 @@ def handle_client(client):
                         send_message(f"{target} is not your friend.", client)
                         continue
 
-                    recent_msgs = chat_history.get(nickname, {}).get(target, [])[-50:]
+                    recent_msgs = recent_messages(nickname, target, 50)
 
                     payload = {
                         "requester": nickname,
@@ -456,7 +1611,7 @@ def handle_client(client):
                         "prompt": prompt,
                         "recent_messages": recent_msgs
                     }
-                    send_message("🔍 Processing helper request, please wait...", client)
+                    send_ai_result(client, caps, "Helper", "🔍 Processing helper request, please wait...", status="running")
 
                     def call_helper_webhook():
                         try:
@@ -468,9 +1623,9 @@ def handle_client(client):
                             r.raise_for_status()
                             result = r.json()
                             helper_response = result.get("response", None) or result.get("reply", "(No response received)")
-                            send_message(f"🧠 Helper Response for {target} on '{prompt[:20]}...':\n\n{helper_response}", client)
+                            send_ai_result(client, caps, "Helper", f"🧠 Helper Response for {target} on '{prompt[:20]}...':\n\n{helper_response}")
                         except Exception as e:
-                            send_message(f"⚠️ Helper Error: {e}", client)
+                            send_ai_result(client, caps, "Helper", f"⚠️ Helper Error: {e}", status="error")
 
                     threading.Thread(target=call_helper_webhook, daemon=True).start()
                     continue
@@ -482,9 +1637,9 @@ def handle_client(client):
                         continue
                     target = parts[1].strip()
 
-                    recent_msgs = chat_history.get(nickname, {}).get(target, [])[-50:]
+                    recent_msgs = recent_messages(nickname, target, 50)
                     if not recent_msgs:
-                        send_message(f"No recent messages with {target} to include in playbook.", client)
+                        send_ai_result(client, caps, "PlayBook", f"No recent messages with {target} to include in playbook.", status="error")
                         continue
 
                     payload = {
@@ -501,11 +1656,11 @@ def handle_client(client):
                                 timeout=120
                             )
                             if r.status_code == 200:
-                                send_message("Playbook generated successfully! Check your Drive.\n", client)
+                                send_ai_result(client, caps, "PlayBook", "Playbook generated successfully! Check your Drive.\n")
                             else:
-                                send_message(f"Workflow error (HTTP {r.status_code}).\n", client)
+                                send_ai_result(client, caps, "PlayBook", f"Workflow error (HTTP {r.status_code}).\n", status="error")
                         except Exception as e:
-                            send_message(f"Error calling PlayBook webhook: {e}\n", client)
+                            send_ai_result(client, caps, "PlayBook", f"Error calling PlayBook webhook: {e}\n", status="error")
 
                     threading.Thread(target=send_playbook, daemon=True).start()
                     continue
@@ -531,12 +1686,17 @@ def handle_client(client):
                             send_message(f"{nickname} wants to be your friend.", clients[t_idx])
                         except:
                             pass
+                        push_event(target, "request_received", name=nickname)
                         save_json(FRIENDS_FILE, {"friends": friends, "pending": pending_requests})
                     continue
 
                 # ---------------- PENDING REQUESTS ----------------
                 elif msg.startswith("/pending"):
                     pending = pending_requests.get(nickname, [])
+                    if "json" in caps:
+                        send_message("PENDING|" + json.dumps(pending, ensure_ascii=False), client)
+                        pending_session = True
+                        continue
                     if not pending:
                         send_message("No pending friend requests.", client)
                         continue
@@ -548,7 +1708,8 @@ def handle_client(client):
                     continue
 
                 # ---------------- FRIEND RESPONSE ----------------
-                elif pending_session and (msg.lower().startswith("yes") or msg.lower().startswith("no")):
+                # Clients that got their pending list from the login snapshot answer without a /pending first
+                elif (pending_session or pending_requests.get(nickname)) and (msg.lower().startswith("yes") or msg.lower().startswith("no")):
                     parts = msg.split(" ", 1)
                     if len(parts) != 2:
                         send_message("Usage: yes <num> or no <num>", client)
@@ -577,6 +1738,8 @@ def handle_client(client):
                             send_message(f"{nickname} accepted your friend request.", clients[r_idx])
                         except:
                             pass
+                        push_event(nickname, "friend_added", name=requester, online=online_status.get(requester, False))
+                        push_event(requester, "friend_added", name=nickname, online=True)
                     else:
                         send_message(f"You rejected {requester}'s friend request.", client)
                     
@@ -586,21 +1749,60 @@ def handle_client(client):
 
                 # ---------------- FRIEND LIST ----------------
                 elif msg.startswith("/friends"):
+                    if "json" in caps:
+                        send_message("FRIENDS|" + json.dumps(friends_records(nickname), ensure_ascii=False), client)
+                        continue
                     flist = friends.get(nickname, [])
                     display = "Your friends:\n"
                     for f in flist:
                         status = "🔥" if online_status.get(f, False) else ""
-                        offline_msg = " 🗣️" if unread_messages.get(nickname, {}).get(f) else ""
+                        offline_msg = " 🗣️" if unread_counts.get(nickname, {}).get(f) else ""
                         display += f"{f} {status}{offline_msg}\n"
                     send_message(display, client)
                     continue
 
+                # ---------------- SEARCH ----------------
+                # /search <words> [--in <peer>]: only an explicit --in narrows the search to one chat
+                elif msg.startswith("/search"):
+                    words = msg.split()[1:]
+                    friend = None
+                    if "--in" in words:
+                        i = words.index("--in")
+                        friend = words[i + 1] if i + 1 < len(words) else ""
+                        del words[i:i + 2]
+                    if not words or friend == "":
+                        send_message("Usage: /search <text> [--in <friend>]", client)
+                        continue
+                    query = " ".join(words)
+                    hits = search_messages(nickname, query, friend)
+                    if "json" in caps:
+                        send_message("SEARCH|" + json.dumps({"query": query, "friend": friend, "hits": hits},
+                                                            ensure_ascii=False), client)
+                        continue
+                    if not hits:
+                        send_message(f"No messages match '{query}'.", client)
+                        continue
+                    display = f"Search results for '{query}':\n"
+                    for hit in hits:
+                        display += f"[{hit['timestamp'][:16]}] {hit['conversation']} | {hit['sender']}: {hit['message'][:80]} ({hit['id']})\n"
+                    send_message(display.strip(), client)
+                    continue
+
                 # ---------------- FILEMANIA ----------------
                 elif msg.startswith("/FILEMANIA|"):
                     try:
                         _, action, file_url = msg.split("|", 2)
+                        force = file_url.endswith("|force")
+                        if force:
+                            file_url = file_url[:-len("|force")]
                         print(f"[FILEMANIA] Received action '{action}' for user '{nickname}'")
 
+                        cache_key = filemania_cache_key(file_url, action)
+                        cached_reply = get_cached_filemania_reply(cache_key) if cache_key and not force else None
+                        if cached_reply:
+                            send_ai_result(client, caps, "FileMania", f"🧠 FileMania Result (cached):\n\n{cached_reply}")
+                            continue
+
                         NGROK_BASE = "https://cd9037313da9.ngrok-free.app" 
                         file_url = file_url.replace(f"http://{HOST}:{HTTP_PORT}", NGROK_BASE)
 
@@ -620,10 +1822,12 @@ def handle_client(client):
                                 response.raise_for_status()
                                 data = response.json()
                                 ai_reply_text = data.get("reply") or f"(File analysis: {action} returned no reply.)"
-                                send_message(f"🧠 FileMania Result:\n\n{ai_reply_text}", client)
+                                if data.get("reply") and cache_key:
+                                    store_filemania_reply(cache_key, data["reply"])
+                                send_ai_result(client, caps, "FileMania", f"🧠 FileMania Result:\n\n{ai_reply_text}")
                             except Exception:
                                 error_msg = traceback.format_exc()
-                                send_message(f"🤖 FileMania ({action}) Error:\n{error_msg}", client)
+                                send_ai_result(client, caps, "FileMania", f"🤖 FileMania ({action}) Error:\n{error_msg}", status="error")
 
                         threading.Thread(target=call_filemania_webhook, daemon=True).start()
 
@@ -632,15 +1836,29 @@ def handle_client(client):
                     continue
 
                 # ---------------- PRIVATE MESSAGE ----------------
-                elif msg.startswith("PRIVATE|"):
+                # PRIVATE_ID|<msg_id>|<recipient>|<text> carries a client-made message ID;
+                # the older PRIVATE|<recipient>|<text> gets one assigned here.
+                elif msg.startswith("PRIVATE|") or msg.startswith("PRIVATE_ID|"):
+                    # Every PRIVATE_ID gets a final answer, SENT or REJECTED, so the client's
+                    # outbox only keeps frames worth retransmitting
+                    fields = msg.split("|", 2)
+                    msg_id = fields[1] if msg.startswith("PRIVATE_ID|") and len(fields) > 2 else None
                     try:
-                        _, recipient, message_text = msg.split("|", 2)
+                        if msg_id:
+                            _, _, recipient, message_text = msg.split("|", 3)
+                        else:
+                            _, recipient, message_text = msg.split("|", 2)
                         if recipient not in friends.get(nickname, []):
-                            send_message(f"{recipient} is not your friend.", client)
+                            reject_message(client, caps, msg_id, f"{recipient} is not your friend.")
                             continue
-                        send_private(nickname, recipient, message_text)
+                        # a retransmit of a message we already stored is only acknowledged again
+                        if msg_id not in recent_message_ids:
+                            send_private(nickname, recipient, message_text, msg_id=msg_id)
+                        if msg_id and "ack" in caps:
+                            # the client forgets its copy on SENT, so only ack what is on disk
+                            history_saver.request(lambda msg_id=msg_id: send_message(f"SENT|{msg_id}", client))
                     except:
-                        send_message("Invalid private message format.", client)
+                        reject_message(client, caps, msg_id, "Invalid private message format.")
                     continue
 
                 # ---------------- CLEAR CHAT ----------------
@@ -653,11 +1871,17 @@ def handle_client(client):
                     if target not in friends.get(nickname, []):
                         send_message(f"{target} is not your friend.", client)
                         continue
-                    if nickname in chat_history and target in chat_history[nickname]:
-                        chat_history[nickname][target] = []
-                    if target in chat_history and nickname in chat_history[target]:
-                        chat_history[target][nickname] = []  
-                    save_json(CHAT_FILE, chat_history)
+                    if target in chat_history.get(nickname, {}):
+                        entries = conversation(nickname, target)
+                        unindex_conversation(conversation_key(nickname, target), entries)
+                        entries.clear()  # the list both sides share
+                    for user, peer in [(nickname, target), (target, nickname)]:
+                        with delivery_lock(user):
+                            delivery_cursors.get(user, {}).pop(peer, None)
+                            delivery_sent.get(user, {}).pop(peer, None)
+                    save_delivery_cursors()
+                    save_chat_history()
+                    drop_conversation_refs(conversation_key(nickname, target))
                     send_message(f"✅ Chat with {target} cleared for both sides.", client)
                     continue                
 
@@ -668,6 +1892,7 @@ def handle_client(client):
                         "/pending             → view pending requests\n"
                         "yes <num>/no <num>   → respond to pending request\n"
                         "/friends             → view friends list\n"
+                        "/search <text> [--in f] → search your messages (prefixes match)\n"
                         "/msg <friend>        → start private chat\n"
                         "/helper <f> <prompt> → AI assistance based on chat context\n"
                         "/Auto <friend> [15m] → enable AutoAI chat\n"
@@ -688,16 +1913,32 @@ def handle_client(client):
         print(f"Client handler error: {e}")
     finally:
         # === PHASE 4: CLEANUP ===
+        # a resumed session may already have replaced this connection; leave the new one alone
         if client in clients:
-            clients.remove(client)
-        if authenticated_user and authenticated_user in nicknames:
-            nicknames.remove(authenticated_user)
-            online_status[authenticated_user] = False
+            idx = clients.index(client)
+            clients.pop(idx)
+            nicknames.pop(idx)
+            if authenticated_user not in nicknames:
+                online_status[authenticated_user] = False
+                session_caps.pop(authenticated_user, None)
+                delivery_sent.pop(authenticated_user, None)
+                backlog_open.discard(authenticated_user)
+                notify_presence(authenticated_user, False)
             print(f"[DISCONNECT] {authenticated_user}")
         client.close()
 
 # ---------------- SERVER STARTUP ----------------
 if __name__ == "__main__":
+    init_file_storage()
+    seed_recent_message_ids()
+    seed_delivery_cursors()
+    rebuild_search_index()
+    delivery_saver.start()
+    history_saver.start()
+    unread_saver.start()
+    threading.Thread(target=start_file_server, daemon=True).start()
+    threading.Thread(target=file_gc_loop, daemon=True).start()
+
     server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server.bind((HOST, PORT))
 
@@ -708,6 +1949,7 @@ if __name__ == "__main__":
 
     server.listen()
     print(f"[SECURE SERVER] Listening on {HOST}:{PORT}")
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))  # shut down through the flush below
 
     try:
         while True:
@@ -717,6 +1959,8 @@ if __name__ == "__main__":
             # Start thread immediately without asking for NICK
             thread = threading.Thread(target=handle_client, args=(client,))
             thread.start()
-    except KeyboardInterrupt:
+    except (KeyboardInterrupt, SystemExit):
         server.close()
+        for saver in (history_saver, delivery_saver, unread_saver):
+            saver.flush()
         print("\n[SERVER SHUTDOWN]")
\ No newline at end of file